@@ -7,9 +7,13 @@ import sys
 path = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, path)
 
-from lib import __version__
+from lib import __version__, limit
+from lib.batch import batch_scan
+from lib.config import Config
 from lib.git import check_git
-from lib.log import basicConfig
+from lib.log import RunningBar, basicConfig
+from lib.metrics import metrics
+from lib.net import close_pools
 from lib.scan import GitScanner
 
 try:
@@ -37,7 +41,35 @@ def main():
     print(BANNER)
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('url')
+    parser.add_argument('url', nargs='?')
+    parser.add_argument(
+        '--targets',
+        default=None,
+        metavar='file',
+        help="scan every url in file ('-' for stdin)")
+    parser.add_argument(
+        '--output',
+        default=None,
+        metavar='file',
+        help='append one result line per target to file')
+    parser.add_argument(
+        '--parallel',
+        type=int,
+        default=Config.PARALLEL,
+        metavar='N',
+        help='targets scanned at once with --targets')
+    parser.add_argument(
+        '--budget',
+        type=int,
+        default=None,
+        metavar='N',
+        help='requests in flight over all targets')
+    parser.add_argument(
+        '--host-limit',
+        type=int,
+        default=None,
+        metavar='N',
+        help='requests in flight per host')
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -48,7 +80,112 @@ def main():
         default=None,
         metavar='logfile',
         help='output verbose log to file')
+    parser.add_argument(
+        '--min-threads',
+        type=int,
+        default=Config.MIN_THREADS,
+        metavar='N',
+        help='lowest requests in flight per host when backing off')
+    parser.add_argument(
+        '--max-threads',
+        type=int,
+        default=Config.THREADS,
+        metavar='N',
+        help='highest requests in flight per host (thread engine)')
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=Config.TIMEOUT,
+        metavar='seconds',
+        help='network timeout per request')
+    parser.add_argument(
+        '--cpu-workers',
+        type=int,
+        default=Config.CPU_WORKERS,
+        metavar='N',
+        help='processes that inflate and parse objects in plan C')
+    parser.add_argument(
+        '--negative-ttl',
+        type=int,
+        default=Config.NEGATIVE_TTL,
+        metavar='seconds',
+        help='remember 404/410 paths for reruns (0 disables)')
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        default=None,
+        metavar='N',
+        help='keep-alive connections per host (default: threads)')
+    parser.add_argument(
+        '--race',
+        action='store_true',
+        default=False,
+        help='probe plan A, B and C at once and keep the first viable')
+    parser.add_argument(
+        '--verify',
+        choices=['full', 'fast', 'off'],
+        default=Config.VERIFY,
+        help='check downloaded objects: full sha1, fast size only, or off '
+        '(default: full)')
+    parser.add_argument(
+        '--metrics',
+        default=None,
+        metavar='FILE',
+        help='write request, byte, latency and phase metrics as json')
+    parser.add_argument(
+        '--progress',
+        action='store_true',
+        default=False,
+        help='show requests, bytes and objects per second while running')
+    parser.add_argument(
+        '--refs',
+        default=Config.REFS_FILE,
+        metavar='FILE',
+        help='branch and tag names to probe, one per line '
+        '(default: doc/refs.txt)')
+    parser.add_argument(
+        '--history',
+        action='store_true',
+        default=False,
+        help='also restore every commit reachable from the refs into '
+        'history/<sha1>/')
+    parser.add_argument(
+        '--size-order',
+        action='store_true',
+        default=False,
+        help='restore the smallest index files first')
+    parser.add_argument(
+        '--store',
+        metavar='DIR',
+        help='object store shared by every target and run, objects found '
+        'there are not downloaded again')
+    parser.add_argument(
+        '--store-size',
+        type=int,
+        default=Config.STORE_SIZE // (1024 * 1024),
+        metavar='MB',
+        help='size cap of --store, least recently used objects go first '
+        '(default: 1024)')
+    parser.add_argument(
+        '--pack',
+        action='store_true',
+        default=False,
+        help='move recovered objects into local packfiles instead of '
+        'keeping one loose file per object')
+    parser.add_argument(
+        '--engine',
+        choices=['thread', 'async'],
+        default='thread',
+        help='fetch engine for plan B and C (default: thread)')
+    parser.add_argument(
+        '--async-limit',
+        type=int,
+        default=Config.ASYNC_LIMIT,
+        metavar='N',
+        help='requests in flight with the async engine')
     args = parser.parse_args()
+    if not args.url and not args.targets:
+        parser.error('either url or --targets is required')
 
     if args.debug:
         level = logging.DEBUG
@@ -56,11 +193,44 @@ def main():
         level = logging.INFO
 
     basicConfig(False, args.log, level)
+    Config.MIN_THREADS = args.min_threads
+    Config.THREADS = args.max_threads
+    Config.TIMEOUT = args.timeout
+    Config.POOL_SIZE = args.pool_size
+    Config.NEGATIVE_TTL = args.negative_ttl
+    Config.CPU_WORKERS = args.cpu_workers
+    Config.ENGINE = args.engine
+    Config.RACE = args.race
+    Config.HISTORY = args.history
+    Config.SIZE_ORDER = args.size_order
+    Config.STORE = args.store and os.path.abspath(args.store)
+    Config.STORE_SIZE = args.store_size * 1024 * 1024
+    Config.PACK = args.pack
+    Config.REFS_FILE = args.refs
+    Config.METRICS = args.metrics
+    Config.VERIFY = args.verify
+    Config.ASYNC_LIMIT = args.async_limit
+    Config.PARALLEL = args.parallel
+    Config.GLOBAL_LIMIT = args.budget
+    Config.HOST_LIMIT = args.host_limit
+    limit.configure()
+    if args.progress:
+        RunningBar.status = metrics.progress
 
     check_git()
 
-    scanner = GitScanner(args.url)
-    scanner.scan()
+    try:
+        if args.targets:
+            # spinners of concurrent scans would overwrite each other
+            RunningBar.move = False
+            batch_scan(args.targets, args.output)
+        else:
+            scanner = GitScanner(args.url)
+            scanner.scan()
+    finally:
+        close_pools()
+        if Config.METRICS:
+            metrics.save(Config.METRICS)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# synthetic repositories for the benchmarks, built with git fast-import
+import argparse
+import os
+import random
+import shutil
+import subprocess
+
+
+def _blob(rnd, size):
+    # text-like and partly compressible, like source files
+    words = [b'alpha', b'beta', b'gamma', b'delta', b'%d' % rnd.random()]
+    out = bytearray()
+    while len(out) < size:
+        out += rnd.choice(words) + (b'\n' if rnd.random() < 0.1 else b' ')
+    return bytes(out[:size])
+
+
+def fast_import_stream(commits, files, blob_size, changes, seed=0):
+    rnd = random.Random(seed)
+    paths = [
+        f'src/d{i % 32:02d}/f{i:06d}.txt'.encode('ascii')
+        for i in range(files)
+    ]
+    yield b'reset refs/heads/master\n'
+    for n in range(commits):
+        touched = paths if n == 0 else rnd.sample(paths, min(changes, files))
+        message = b'commit %d' % n
+        yield b'commit refs/heads/master\n'
+        yield b'committer bench <bench@example.com> %d +0000\n' % (
+            1600000000 + n)
+        yield b'data %d\n%s\n' % (len(message), message)
+        for path in touched:
+            data = _blob(rnd, blob_size)
+            yield b'M 100644 inline %s\n' % path
+            yield b'data %d\n%s\n' % (len(data), data)
+        yield b'\n'
+
+
+def git(cwd, *args, **kwargs):
+    return subprocess.run(['git', *args], cwd=cwd, check=True,
+                          capture_output=True, **kwargs)
+
+
+def make_repo(path, commits=20, files=100, blob_size=2048, changes=5,
+              layout='packed', seed=0):
+    # a work tree at path whose .git is what the scanner will see
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    git(path, 'init', '-q')
+    stream = b''.join(
+        fast_import_stream(commits, files, blob_size, changes, seed))
+    git(path, 'fast-import', '--quiet', input=stream)
+    git(path, 'reset', '-q', '--hard', 'master')
+    gitdir = os.path.join(path, '.git')
+    if layout == 'loose':
+        packdir = os.path.join(gitdir, 'objects', 'pack')
+        for name in os.listdir(packdir):
+            if not name.endswith('.pack'):
+                continue
+            # unpack-objects skips objects the repository already has, so
+            # the pack has to leave it first
+            packpath = os.path.join(path, name)
+            os.replace(os.path.join(packdir, name), packpath)
+            os.remove(os.path.join(packdir, name[:-5] + '.idx'))
+            with open(packpath, 'rb') as f:
+                git(path, 'unpack-objects', '-q', stdin=f)
+            os.remove(packpath)
+    else:
+        git(path, 'repack', '-adq')
+    os.makedirs(os.path.join(gitdir, 'info'), exist_ok=True)
+    # info/refs and objects/info/packs, needed by dumb http clones
+    git(path, 'update-server-info')
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--commits', type=int, default=20)
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--blob-size', type=int, default=2048)
+    parser.add_argument('--changes', type=int, default=5,
+                        help='files changed per commit')
+    parser.add_argument('--layout', choices=['packed', 'loose'],
+                        default='packed')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    make_repo(args.path, args.commits, args.files, args.blob_size,
+              args.changes, args.layout, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# offline benchmark: build a synthetic repo, serve it locally and time
+# GitHack plans against it
+#
+#   python3 bench/run.py --commits 50 --files 500 --plans A,B,C \
+#       --latency 0.02 --json bench.json
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHDIR)
+sys.path.insert(0, os.path.dirname(BENCHDIR))
+
+from lib.config import Config  # noqa: E402
+from repo import make_repo  # noqa: E402
+from server import serve  # noqa: E402
+
+GITHACK = os.path.join(os.path.dirname(BENCHDIR), 'GitHack.py')
+
+
+def plan_server(plan, worktree):
+    # (root, listing): plan A needs the .git itself at the url, B a
+    # listing, C neither
+    if plan == 'A':
+        return os.path.join(worktree, '.git'), False
+    return worktree, plan == 'B'
+
+
+def run_githack(url, args):
+    # (exit code, wall seconds, peak rss in MB, metrics)
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+        metrics_path = f.name
+    cmd = [sys.executable, GITHACK, url, '--metrics', metrics_path, *args]
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    # wait4 gives this child's own peak rss, not the max of all children
+    _, status, usage = os.wait4(proc.pid, 0)
+    # os.waitstatus_to_exitcode is 3.9+
+    if os.WIFEXITED(status):
+        proc.returncode = os.WEXITSTATUS(status)
+    else:
+        proc.returncode = -os.WTERMSIG(status)
+    wall = time.perf_counter() - start
+    try:
+        with open(metrics_path, encoding='utf-8') as f:
+            metrics = json.load(f)['metrics']
+    except (OSError, ValueError):
+        metrics = {}
+    finally:
+        os.remove(metrics_path)
+    return proc.returncode, wall, usage.ru_maxrss / 1024, metrics
+
+
+def head_of(path):
+    r = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path,
+                       capture_output=True)
+    return r.stdout.strip() if r.returncode == 0 else None
+
+
+def plan_ran(metrics):
+    # plans run in order and each one is timed, the last one timed is the
+    # one that got the repository
+    ran = [plan for plan in 'ABC' if f'plan.{plan}' in metrics]
+    return ran[-1] if ran else None
+
+
+def bench_plan(plan, worktree, args):
+    root, listing = plan_server(plan, worktree)
+    server, stats = serve(root, 0, args.latency, args.bandwidth,
+                          args.miss_rate, listing)
+    port = server.server_address[1]
+    dist = os.path.join(Config.DIST, f'127.0.0.1_{port}')
+    shutil.rmtree(dist, ignore_errors=True)
+    try:
+        code, wall, rss, metrics = run_githack(
+            f'http://127.0.0.1:{port}', args.args.split())
+        # ok: the plan under test got the served HEAD, a fallback to a
+        # later plan measures that plan instead
+        ok = (code == 0 and plan_ran(metrics) == plan and
+              head_of(dist) == head_of(worktree))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(dist, ignore_errors=True)
+    return {
+        'plan': plan,
+        'layout': args.layout,
+        'ok': ok,
+        'ran': plan_ran(metrics),
+        'wall': round(wall, 3),
+        'requests': stats.requests,
+        'bytes': stats.bytes,
+        'client_requests': metrics.get('http.requests', 0),
+        'objects': metrics.get('walk.objects', 0),
+        'rss_mb': round(rss, 1),
+        'plan_seconds': metrics.get(f'plan.{plan}', {}).get('seconds'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--commits', type=int, default=20)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--blob-size', type=int, default=2048)
+    parser.add_argument('--changes', type=int, default=10)
+    parser.add_argument('--layout', choices=['packed', 'loose'],
+                        default='loose')
+    parser.add_argument('--plans', default='A,B,C')
+    parser.add_argument('--latency', type=float, default=0, metavar='seconds')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        metavar='bytes/s')
+    parser.add_argument('--miss-rate', type=float, default=0, metavar='0-1',
+                        help='share of paths answered with 404')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--args', default='',
+                        help='extra GitHack arguments, e.g. "--engine async"')
+    parser.add_argument('--json', metavar='FILE', help='append results')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='githack-bench-')
+    try:
+        worktree = make_repo(
+            os.path.join(workdir, 'repo'), args.commits, args.files,
+            args.blob_size, args.changes, args.layout)
+        results = []
+        print('plan layout  ok      wall  requests       bytes  objects  '
+              'rss MB')
+        for _ in range(args.repeat):
+            for plan in args.plans.split(','):
+                r = bench_plan(plan.strip().upper(), worktree, args)
+                results.append(r)
+                print(f"{r['plan']:<4} {r['layout']:<6} {str(r['ok']):<5} "
+                      f"{r['wall']:>7.2f}s {r['requests']:>9} "
+                      f"{r['bytes']:>11} {r['objects']:>8} "
+                      f"{r['rss_mb']:>7.1f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'a', encoding='utf-8') as f:
+            for r in results:
+                r['params'] = {
+                    k: v
+                    for k, v in vars(args).items() if k != 'json'
+                }
+                print(json.dumps(r), file=f)
+
+
+if __name__ == '__main__':
+    main()
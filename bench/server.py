@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# a stand-in for an exposed .git: serves a directory over http with
+# optional latency, bandwidth cap, random 404s and directory listing
+import argparse
+import functools
+import hashlib
+import http.server
+import os
+import threading
+import time
+import urllib.parse
+
+
+class Stats(object):
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def request(self):
+        with self._lock:
+            self.requests += 1
+
+    def sent(self, size):
+        with self._lock:
+            self.bytes += size
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    # set by serve()
+    latency = 0
+    bandwidth = 0
+    miss_rate = 0
+    listing = False
+    hide = ()
+    stats = None
+
+    def _missing(self):
+        path = self.path.split('?', 1)[0]
+        if any(h in path for h in self.hide):
+            return True
+        if not self.miss_rate or path.endswith('/'):
+            return False
+        # the same paths miss on every request, retries don't help
+        digest = hashlib.sha1(path.encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'big') / 2**32 < self.miss_rate
+
+    def send_head(self):
+        self.stats.request()
+        if self.latency:
+            time.sleep(self.latency)
+        if self._missing():
+            self.send_error(404)
+            return None
+        parts = urllib.parse.urlsplit(self.path)
+        if (os.path.isdir(self.translate_path(self.path)) and
+                not parts.path.endswith('/')):
+            # python < 3.8 sends this redirect without a Content-Length, a
+            # keep-alive client then waits for a body until it times out
+            self.send_response(301)
+            location = parts._replace(path=parts.path + '/')
+            self.send_header('Location', urllib.parse.urlunsplit(location))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        return super().send_head()
+
+    def list_directory(self, path):
+        if self.listing:
+            return super().list_directory(path)
+        self.send_error(403)
+        return None
+
+    def copyfile(self, source, outputfile):
+        sent = 0
+        start = time.perf_counter()
+        while True:
+            chunk = source.read(16 * 1024)
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            sent += len(chunk)
+            if self.bandwidth:
+                # sleep until the average rate is back under the cap
+                ahead = sent / self.bandwidth - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        self.stats.sent(sent)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(http.server.ThreadingHTTPServer):
+    # scanners open many connections at once
+    request_queue_size = 256
+    daemon_threads = True
+
+
+def serve(root, port=0, latency=0, bandwidth=0, miss_rate=0, listing=False,
+          hide=()):
+    # returns (server, stats), the server runs in a daemon thread
+    stats = Stats()
+    handler = type(
+        'BenchHandler', (Handler, ), {
+            'latency': latency,
+            'bandwidth': bandwidth,
+            'miss_rate': miss_rate,
+            'listing': listing,
+            'hide': tuple(hide),
+            'stats': stats,
+        })
+    server = Server(('127.0.0.1', port),
+                    functools.partial(handler, directory=root))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', help='directory holding the .git to serve')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0, metavar='seconds')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        metavar='bytes/s')
+    parser.add_argument('--miss-rate', type=float, default=0, metavar='0-1')
+    parser.add_argument('--listing', action='store_true', default=False)
+    parser.add_argument('--hide', action='append', default=[],
+                        metavar='path', help='always answer 404 for it')
+    args = parser.parse_args()
+    server, _ = serve(
+        os.path.abspath(args.root), args.port, args.latency, args.bandwidth,
+        args.miss_rate, args.listing, args.hide)
+    print(f'serving {args.root} on http://127.0.0.1:{args.port}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,578 @@
+import asyncio
+import concurrent.futures
+import itertools
+import os
+import ssl
+import time
+import tempfile
+import urllib.parse
+import urllib.request
+import zlib
+
+from . import limit, log
+from .config import Config
+from .metrics import metrics
+from .git import (LoosePacker, index_entries, index_seeds, object_check,
+                  open_packs, pack_check, restore_entry, restored,
+                  verify_backoff, walk_digest, walk_object, walk_unchanged)
+from .net import (NOT_MODIFIED, REDIRECT, RETRY, body_decoder,
+                  cached_miss, dirlist_local, handle_response, has_body,
+                  is_immutable, is_stale, load_file, parse_dirlist, rand_ua,
+                  request_failed, request_headers, save_file)
+from .oid import ShaSet, to_hex, to_raw
+from .refs import RefDiscovery, load_wordlist
+from .sched import INDEX_BLOB, REF, TREE
+from .state import WalkState, meta_path
+from .store import store
+
+
+async def in_executor(executor, fn, *args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, fn, *args)
+
+
+class AsyncHTTP(object):
+    def __init__(self, size, disk=None):
+        # one limit for every request in flight, whatever the caller
+        self._slots = asyncio.Semaphore(size)
+        self._idle = {}
+        # the same proxies as net.ConnectionPool
+        self._proxies = urllib.request.getproxies()
+        self.disk = disk
+
+    async def _disk(self, fn, *args):
+        return await in_executor(self.disk, fn, *args)
+
+    async def _io(self, coro):
+        return await asyncio.wait_for(coro, Config.TIMEOUT)
+
+    async def _connect(self, scheme, netloc):
+        parts = urllib.parse.urlsplit(f'{scheme}://{netloc}')
+        ctx = ssl.create_default_context() if scheme == 'https' else None
+        port = parts.port or (443 if ctx else 80)
+        proxy = self._proxies.get(scheme)
+        if not proxy:
+            return await self._io(
+                asyncio.open_connection(parts.hostname, port, ssl=ctx))
+        proxy = urllib.parse.urlsplit(proxy)
+        conn = await self._io(
+            asyncio.open_connection(proxy.hostname, proxy.port or 80))
+        if ctx:
+            authority = netloc if parts.port else f'{netloc}:{port}'
+            conn = await self._tunnel(conn, authority, parts.hostname, ctx)
+        return conn
+
+    async def _tunnel(self, conn, authority, hostname, ctx):
+        # https through a proxy: CONNECT, then tls inside it, as set_tunnel
+        reader, writer = conn
+        writer.write(f'CONNECT {authority} HTTP/1.1\r\n'
+                     f'Host: {authority}\r\n\r\n'.encode('latin-1'))
+        await self._io(writer.drain())
+        try:
+            status, _ = await self._read_head(reader)
+            if status != 200:
+                raise OSError(f'tunnel connection failed: {status}')
+            if hasattr(writer, 'start_tls'):
+                # 3.11+, the old writer must not be dropped: it would close
+                # the transport underneath
+                await self._io(
+                    writer.start_tls(ctx, server_hostname=hostname))
+                return reader, writer
+            loop = asyncio.get_event_loop()
+            transport = await self._io(
+                loop.start_tls(writer.transport,
+                               writer.transport.get_protocol(), ctx,
+                               server_hostname=hostname))
+        except Exception:
+            writer.close()
+            raise
+        return reader, asyncio.StreamWriter(transport,
+                                            transport.get_protocol(), reader,
+                                            loop)
+
+    async def _read_body(self, reader, headers, write):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                line = await self._io(reader.readline())
+                size = int(line.split(b';', 1)[0].strip() or b'0', 16)
+                if size == 0:
+                    # skip trailers
+                    while (await self._io(reader.readline())).strip():
+                        pass
+                    return True
+                while size > 0:
+                    chunk = await self._io(
+                        reader.read(min(size, Config.CHUNK_SIZE)))
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(b'', size)
+                    await write(chunk)
+                    size -= len(chunk)
+                await self._io(reader.readline())
+        if 'content-length' in headers:
+            left = int(headers['content-length'])
+            while left > 0:
+                chunk = await self._io(
+                    reader.read(min(left, Config.CHUNK_SIZE)))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', left)
+                await write(chunk)
+                left -= len(chunk)
+            return True
+        # no framing: the body ends when the server closes the connection
+        while True:
+            chunk = await self._io(reader.read(Config.CHUNK_SIZE))
+            if not chunk:
+                return False
+            await write(chunk)
+
+    async def _read_head(self, reader):
+        line = await self._io(reader.readline())
+        if not line:
+            raise ConnectionResetError('connection closed by server')
+        _, status, *_ = line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await self._io(reader.readline())
+            if not line.strip():
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        return int(status), headers
+
+    async def _send(self, conn, netloc, target, extra=None):
+        # the request, then the status and headers of its response
+        reader, writer = conn
+        request = (f'GET {target} HTTP/1.1\r\n'
+                   f'Host: {netloc}\r\n'
+                   f'User-Agent: {rand_ua()}\r\n'
+                   'Accept: */*\r\n')
+        for key, value in (extra or {}).items():
+            request += f'{key}: {value}\r\n'
+        request += 'Connection: keep-alive\r\n\r\n'
+        writer.write(request.encode('latin-1'))
+        await self._io(writer.drain())
+
+        return await self._read_head(reader)
+
+    async def _receive(self, conn, status, headers, sink=None):
+        # (body, whether the connection can be reused)
+        reader, _ = conn
+        chunks = []
+        decoder = body_decoder(headers.get('content-encoding'))
+        if sink and status == 200:
+            # a retried response starts over
+            sink.seek(0)
+            sink.truncate()
+
+            async def _write(chunk):
+                metrics.counter('http.bytes').inc(len(chunk))
+                if decoder:
+                    chunk = decoder.decompress(chunk)
+                await self._disk(sink.write, chunk)
+        else:
+
+            async def _write(chunk):
+                metrics.counter('http.bytes').inc(len(chunk))
+                chunks.append(decoder.decompress(chunk) if decoder else chunk)
+
+        framed = True
+        if has_body(status):
+            framed = await self._read_body(reader, headers, _write)
+        if decoder and sink and status == 200:
+            await self._disk(sink.write, decoder.flush())
+        elif decoder:
+            chunks.append(decoder.flush())
+        body = True if sink and status == 200 else b''.join(chunks)
+        keep = framed and headers.get('connection', '').lower() != 'close'
+        return body, keep
+
+    async def _fetch(self, netpath, sink=None, extra=None):
+        parts = urllib.parse.urlsplit(netpath)
+        key = (parts.scheme, parts.netloc)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        if parts.scheme == 'http' and self._proxies.get('http'):
+            # plain http proxies want the absolute url in the request line
+            target = netpath
+        idle = self._idle.setdefault(key, [])
+        reused = bool(idle)
+        conn = status = None
+        try:
+            conn = idle.pop() if idle else await self._connect(*key)
+            status, headers = await self._send(conn, parts.netloc, target,
+                                               extra)
+            body, keep = await self._receive(conn, status, headers, sink)
+        except (OSError, ValueError, zlib.error, asyncio.TimeoutError,
+                asyncio.IncompleteReadError) as err:
+            if conn:
+                conn[1].close()
+            # no status, the error stands in for the body
+            return None, {}, err, is_stale(err, reused and status is None)
+        if keep:
+            idle.append(conn)
+        else:
+            conn[1].close()
+        return status, headers, body, False
+
+    async def get(self, netpath, retry=3, redirect=5, sink=None,
+                  revalidate=False):
+        if cached_miss(netpath):
+            return None
+        hostlimit = limit.host(netpath)
+        extra = request_headers(netpath, revalidate)
+        while retry > 0:
+            async with self._slots:
+                await hostlimit.acquire_async()
+                await limit.budget.acquire_async()
+                try:
+                    start = time.perf_counter()
+                    metrics.counter('http.requests').inc()
+                    status, headers, body, stale = await self._fetch(
+                        netpath, sink, extra)
+                    latency = time.perf_counter() - start
+                finally:
+                    limit.budget.release()
+                    hostlimit.release()
+            if status is None:
+                if request_failed(hostlimit, netpath, body, stale):
+                    retry -= 1
+                continue
+            action, result = handle_response(netpath, status, headers, body,
+                                             latency, hostlimit, revalidate)
+            if action == RETRY:
+                retry -= 1
+            elif action == REDIRECT:
+                if not redirect:
+                    return None
+                return await self.get(result, retry, redirect - 1, sink,
+                                      revalidate)
+            else:
+                return result
+        return None
+
+    def close(self):
+        for idle in self._idle.values():
+            for _, writer in idle:
+                writer.close()
+        self._idle.clear()
+
+
+class AsyncEngine(object):
+    def __init__(self, size=None):
+        self.size = size or Config.ASYNC_LIMIT
+        self.http = None
+        # disk writes stay off the event loop
+        self.disk = concurrent.futures.ThreadPoolExecutor(Config.DISK_THREADS)
+        # local path => future of a download in flight
+        self._downloads = {}
+
+    async def _disk(self, fn, *args):
+        return await in_executor(self.disk, fn, *args)
+
+    async def _run_queue(self, worker, items, q=None):
+        # a worker may push follow-up items into the queue it is fed from
+        if q is None:
+            q = asyncio.Queue()
+        for item in items:
+            q.put_nowait(item)
+
+        async def _worker():
+            while True:
+                item = await q.get()
+                try:
+                    await worker(item, q)
+                except Exception as err:
+                    log.error(err)
+                finally:
+                    q.task_done()
+
+        workers = [asyncio.ensure_future(_worker()) for _ in range(self.size)]
+        await q.join()
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    async def download(self, localpath, netpath):
+        log.debug('download ' + netpath)
+        data = await self.http.get(
+            netpath, revalidate=os.path.exists(localpath))
+        if data is NOT_MODIFIED:
+            return await self._disk(load_file, localpath)
+        if data:
+            await self._disk(save_file, localpath, data)
+        return data
+
+    async def load_or_get(self, basepair, path, cover=False):
+        localbase, netbase = basepair
+        localpath = os.path.join(localbase, path)
+        netpath = f"{netbase.rstrip('/')}/{path.lstrip('/')}"
+
+        ret = None
+        if cover or not os.path.exists(localpath):
+            if not (is_immutable(path) and
+                    await self._disk(store.get, path, localpath)):
+                ret = await self.download(localpath, netpath)
+                if ret and is_immutable(path):
+                    await self._disk(store.put, path, localpath)
+        else:
+            metrics.counter('fetch.reused').inc()
+
+        return ret or await self._disk(load_file, localpath)
+
+    async def stream_download(self, localpath, netpath, check=None):
+        # check(partpath) runs on the disk executor, see net.stream_download
+        log.debug('download ' + netpath)
+        dirname = os.path.dirname(localpath)
+        os.makedirs(dirname, exist_ok=True)
+        fd, partpath = tempfile.mkstemp(
+            dir=dirname, prefix='.', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                ok = await self.http.get(
+                    netpath, sink=f, revalidate=os.path.exists(localpath))
+            if ok is NOT_MODIFIED:
+                return True
+            if ok and check is not None:
+                ok = await self._disk(check, partpath)
+            if ok:
+                os.replace(partpath, localpath)
+        finally:
+            if os.path.exists(partpath):
+                os.remove(partpath)
+        return bool(ok)
+
+    async def cached_download(self, path, localpath, netpath, check=None):
+        # see net.cached_download
+        if not is_immutable(path):
+            return await self.stream_download(localpath, netpath, check)
+        if await self._disk(store.get, path, localpath):
+            return True
+        ok = await self.stream_download(localpath, netpath, check)
+        if ok:
+            await self._disk(store.put, path, localpath)
+        return ok
+
+    async def fetch(self, basepair, path, cover=False, check=None):
+        localbase, netbase = basepair
+        localpath = os.path.join(localbase, path)
+        netpath = f"{netbase.rstrip('/')}/{path.lstrip('/')}"
+
+        if cover or not os.path.exists(localpath):
+            await self.cached_download(path, localpath, netpath, check)
+        else:
+            metrics.counter('fetch.reused').inc()
+
+        return localpath if os.path.exists(localpath) else None
+
+    async def fetch_object(self, gitpair, h, packs=None):
+        # the network part; inflating and parsing then run on the disk
+        # executor with the file already local
+        if packs is not None and h in packs:
+            return True
+        localgit, _ = gitpair
+        localpath = os.path.join(localgit, 'objects', h[:2], h[2:])
+        if os.path.exists(localpath):
+            metrics.counter('fetch.reused').inc()
+            return True
+        # the walk and the index restore may want one object at once
+        pending = self._downloads.get(localpath)
+        if pending is not None:
+            metrics.counter('fetch.shared').inc()
+            return await asyncio.shield(pending)
+        future = asyncio.get_event_loop().create_future()
+        self._downloads[localpath] = future
+        found = False
+        try:
+            found = await self.download_object(gitpair, h)
+        finally:
+            del self._downloads[localpath]
+            future.set_result(found)
+        return found
+
+    async def download_object(self, gitpair, h):
+        localgit, netgit = gitpair
+        path = f'objects/{h[:2]}/{h[2:]}'
+        localpath = os.path.join(localgit, path)
+        for attempt in range(Config.VERIFY_RETRIES + 1):
+            await asyncio.sleep(verify_backoff(attempt))
+            rejected = []
+            await self.cached_download(path, localpath, f'{netgit}/{path}',
+                                       object_check(gitpair, h, rejected))
+            if os.path.exists(localpath):
+                return True
+            if not rejected:
+                return False
+        log.error(f'object {h} still corrupt after {attempt + 1} attempts')
+        return False
+
+    async def fake_clone(self, gitpair):
+        refs = RefDiscovery(load_wordlist(Config.REFS_FILE))
+
+        async def _load(item, q):
+            path, cover, hash_cap = item
+            data = await self.load_or_get(gitpair, path, cover)
+            for probe in refs.feed(path, data, hash_cap):
+                q.put_nowait(probe)
+
+        await self._run_queue(_load, refs.probes())
+        log.info(f'refs: {len(refs.refs)} found, {len(refs.sha1)} seeds')
+        sha1 = refs.sha1
+        packnames = refs.packnames
+        sha1.update(await self._disk(index_seeds, gitpair))
+
+        state = WalkState(meta_path(gitpair, 'state.db'))
+        digest = await self._disk(walk_digest, gitpair, sha1, packnames)
+        if walk_unchanged(gitpair, state, digest, packnames):
+            log.info('refs unchanged since the last scan, skip walk')
+            metrics.counter('walk.skipped').inc()
+            state.close()
+            return
+        # unset until the walk completes, a rerun resumes it
+        state.set('walked', None)
+        packs = await self.load_packs(gitpair, packnames)
+        try:
+            # the index restore is scheduled along with the walk, a blob
+            # both want is fetched once
+            entries = await self._disk(index_entries, gitpair)
+            await self.hashes_walk(gitpair, sha1, packs, state, entries)
+            state.set('walked', digest)
+        finally:
+            state.close()
+            packs.close()
+
+    async def load_packs(self, gitpair, names):
+        async def _fetch(name, q):
+            path = f'objects/pack/{name}'
+            if await self.fetch(gitpair, path + '.idx',
+                                check=pack_check(path + '.idx')):
+                idxpath = os.path.join(localgit, path + '.idx')
+                await self.fetch(gitpair, path + '.pack',
+                                 check=pack_check(path + '.pack', idxpath))
+
+        localgit, _ = gitpair
+        await self._run_queue(_fetch, names)
+        # checks every index against its pack
+        return await self._disk(open_packs, gitpair, names)
+
+    async def hashes_walk(self, gitpair, hashes, packs=None, state=None,
+                          entries=()):
+        # priority classes as in git.hashes_walk: (class, key, order, item)
+        # with a decreasing order, so sha1s of a class go depth first
+        localgit, _ = gitpair
+        seeds = {to_raw(h) for h in hashes}
+        if state is None:
+            usedhash = ShaSet(seeds)
+            pending = list(usedhash)
+        else:
+            usedhash, pending = state.frontier(hashes)
+        order = itertools.count(0, -1)
+        items = [(REF if raw in seeds else TREE, 0, next(order), raw)
+                 for raw in pending]
+        for i, entry in enumerate(entries):
+            key = entry.size if Config.SIZE_ORDER else i
+            items.append((INDEX_BLOB, key, next(order), entry))
+        packer = None
+        if Config.PACK and packs is not None:
+            packer = LoosePacker(gitpair, packs)
+
+        async def _packed(h):
+            batch = packer.add(h) if packer else None
+            if batch:
+                await self._disk(packer.write, batch)
+
+        async def _walk(item, q):
+            priority, _, _, raw = item
+            if priority == INDEX_BLOB:
+                await _restore(raw)
+                return
+            h = to_hex(raw)
+            if await self.fetch_object(gitpair, h, packs):
+                typ, children = await self._disk(walk_object, gitpair, h,
+                                                 packs)
+            else:
+                log.error('object not found: ' + h)
+                typ, children = None, {}
+            metrics.counter('walk.objects').inc()
+            if typ is None:
+                metrics.counter('walk.missing').inc()
+            else:
+                await _packed(h)
+            if state is not None:
+                state.record(h, typ, children)
+            for child, priority in children.items():
+                if usedhash.add(child):
+                    q.put_nowait((priority, 0, next(order), child))
+
+        async def _restore(entry):
+            ok = await self.fetch_object(gitpair, to_hex(entry.sha1), packs)
+            if ok:
+                ok = await self._disk(restore_entry, gitpair, entry, packs)
+            else:
+                metrics.counter('index.errors').inc()
+                log.error(f'restore {entry.name} failed: object not found')
+            restored(entry, ok, localgit)
+            if ok:
+                await _packed(to_hex(entry.sha1))
+
+        with metrics.time('phase.walk'):
+            try:
+                await self._run_queue(_walk, items, asyncio.PriorityQueue())
+            finally:
+                if packer:
+                    await self._disk(packer.close)
+        log.summary('walk', localgit).close()
+        log.summary('index', localgit).close()
+        return usedhash
+
+    async def dirlist_spider(self, basepair):
+        localbase, netbase = basepair
+        localbase = localbase.rstrip('/')
+        netbase = netbase.rstrip('/')
+        seen = {'/'}
+
+        async def _crawl(path, q):
+            localpath = dirlist_local(localbase, path)
+            netpath = f"{netbase}/{path.lstrip('/')}"
+            if path.endswith('/'):
+                log.debug('detect path: ' + path)
+                os.makedirs(localpath, exist_ok=True)
+                metrics.counter('dirlist.pages').inc()
+                page = await self.http.get(netpath)
+                if page:
+                    for name in parse_dirlist(page, netpath):
+                        if path + name not in seen:
+                            seen.add(path + name)
+                            q.put_nowait(path + name)
+            elif is_immutable(path) and os.path.exists(localpath):
+                log.debug('reuse file: ' + path)
+            else:
+                log.debug('detect file: ' + path)
+                metrics.counter('dirlist.files').inc()
+                await self.cached_download(path, localpath, netpath)
+
+        with metrics.time('phase.dirlist'):
+            await self._run_queue(_crawl, ['/'])
+
+    def run(self, coro_fn, *args):
+        async def _main():
+            self.http = AsyncHTTP(self.size, self.disk)
+            try:
+                return await coro_fn(*args)
+            finally:
+                self.http.close()
+
+        try:
+            return asyncio.run(_main())
+        finally:
+            self.disk.shutdown()
+
+
+def fake_clone(gitpair):
+    engine = AsyncEngine()
+    return engine.run(engine.fake_clone, gitpair)
+
+
+def dirlist_spider(basepair):
+    engine = AsyncEngine()
+    return engine.run(engine.dirlist_spider, basepair)
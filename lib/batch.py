@@ -0,0 +1,60 @@
+import concurrent.futures
+import sys
+import threading
+import time
+
+from . import log
+from .config import Config
+from .scan import GitScanner
+
+
+def read_targets(f):
+    # a url listed twice would be scanned twice into the same directory
+    seen = set()
+    for line in f:
+        url = line.strip()
+        if url and not url.startswith('#') and url.rstrip('/') not in seen:
+            seen.add(url.rstrip('/'))
+            yield url
+
+
+def scan_target(url):
+    start = time.perf_counter()
+    cwd = '-'
+    try:
+        scanner = GitScanner(url)
+        cwd = scanner.cwd
+        status = 'success' if scanner.scan() else 'fail'
+    except Exception as err:
+        log.error(f'scan {url} failed: {err}')
+        status = 'error'
+    elapsed = round(time.perf_counter() - start, 2)
+    return f'{status}\t{url}\t{cwd}\t{elapsed}s'
+
+
+def batch_scan(targets, output=None):
+    out = open(output, 'a', encoding='utf-8') if output else sys.stdout
+    out_lock = threading.Lock()
+
+    def _report(future):
+        with out_lock:
+            print(future.result(), file=out, flush=True)
+
+    src = sys.stdin if targets == '-' else open(targets, encoding='utf-8')
+    try:
+        with concurrent.futures.ThreadPoolExecutor(Config.PARALLEL) as executor:
+            pending = set()
+            # targets are read lazily, only a few more than are running
+            for url in read_targets(src):
+                while len(pending) >= Config.PARALLEL * 2:
+                    _, pending = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                future = executor.submit(scan_target, url)
+                future.add_done_callback(_report)
+                pending.add(future)
+    finally:
+        if src is not sys.stdin:
+            src.close()
+        if out is not sys.stdout:
+            out.close()
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+import time
+
+from .config import Config
+
+PERMANENT = {404, 410}
+
+
+class NegativeCache(object):
+    def __init__(self):
+        # url => expiry (epoch seconds), only for permanent misses
+        self._misses = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, url):
+        expires = self._misses.get(url)
+        if expires is None:
+            return False
+        if expires < time.time():
+            with self._lock:
+                self._misses.pop(url, None)
+            return False
+        return True
+
+    def add(self, url, status):
+        # transient errors (timeouts, 5xx, 429) are never cached
+        if status not in PERMANENT or not Config.NEGATIVE_TTL:
+            return False
+        with self._lock:
+            self._misses[url] = time.time() + Config.NEGATIVE_TTL
+        return True
+
+    def discard(self, url):
+        with self._lock:
+            self._misses.pop(url, None)
+
+    def load(self, path):
+        if not Config.NEGATIVE_TTL or not os.path.exists(path):
+            return
+        try:
+            with open(path, encoding='utf-8') as f:
+                misses = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        with self._lock:
+            for url, expires in misses.items():
+                if expires > now:
+                    self._misses[url] = expires
+
+    def save(self, path, prefix=''):
+        now = time.time()
+        with self._lock:
+            misses = {
+                url: expires
+                for url, expires in self._misses.items()
+                if url.startswith(prefix) and expires > now
+            }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(misses, f, indent=0, sort_keys=True)
+
+
+negative = NegativeCache()
+
+
+class Validators(object):
+    def __init__(self):
+        # url => (etag, last-modified) of the copy on disk
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def headers(self, url):
+        etag, modified = self._tags.get(url, (None, None))
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+        return headers
+
+    def update(self, url, etag, modified):
+        with self._lock:
+            if etag or modified:
+                self._tags[url] = (etag, modified)
+            else:
+                self._tags.pop(url, None)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, encoding='utf-8') as f:
+                tags = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            for url, (etag, modified) in tags.items():
+                self._tags[url] = (etag, modified)
+
+    def save(self, path, prefix=''):
+        with self._lock:
+            tags = {
+                url: tag
+                for url, tag in self._tags.items() if url.startswith(prefix)
+            }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(tags, f, indent=0, sort_keys=True)
+
+
+validators = Validators()
@@ -5,5 +5,31 @@ class Config:
     BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     DIST = os.path.join(BASEDIR, 'dist')
     UA_FILE = os.path.join(BASEDIR, 'doc', 'user-agents.txt')
-    THREADS = 8
+    REFS_FILE = os.path.join(BASEDIR, 'doc', 'refs.txt')
+    THREADS = 32
+    MIN_THREADS = 2
+    START_THREADS = 8
     TIMEOUT = 8
+    POOL_SIZE = None
+    ENGINE = 'thread'
+    ASYNC_LIMIT = 64
+    DISK_THREADS = 4
+    PARALLEL = 4
+    GLOBAL_LIMIT = None
+    HOST_LIMIT = None
+    RACE = False
+    PACK_CACHE = 64 * 1024 * 1024
+    CHUNK_SIZE = 64 * 1024
+    NEGATIVE_TTL = 24 * 60 * 60
+    CPU_WORKERS = 0
+    CPU_BATCH = 256
+    HISTORY = False
+    SIZE_ORDER = False
+    STORE = None
+    STORE_SIZE = 1024 * 1024 * 1024
+    PACK = False
+    PACK_BATCH = 10000
+    METRICS = None
+    VERIFY = 'full'
+    VERIFY_RETRIES = 2
+    VERIFY_BACKOFF = 0.5
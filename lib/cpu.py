@@ -0,0 +1,70 @@
+import concurrent.futures
+import hashlib
+import multiprocessing
+import zlib
+
+from .config import Config
+from .pack import PackStore
+from .parser import object_children
+
+# per worker process, each pack opened once
+_packs = None
+_opened = set()
+
+
+def _init(pack_files):
+    global _packs
+    _packs = PackStore()
+    _open(pack_files)
+
+
+def _open(pack_files):
+    for packpath, idxpath in pack_files:
+        if packpath not in _opened:
+            _opened.add(packpath)
+            _packs.add(packpath, idxpath)
+
+
+def inspect(batch, pack_files=()):
+    # [(sha1, localpath or None for packed)] => [(sha1, type, children)],
+    # type is None when the object is unreadable or its sha1 doesn't match;
+    # pack_files: the packs so far, --pack writes new ones during the walk
+    _open(pack_files)
+    results = []
+    for h, localpath in batch:
+        try:
+            if localpath is None:
+                data = _packs.read_raw(h)
+            else:
+                with open(localpath, 'rb') as f:
+                    data = zlib.decompress(f.read())
+            if hashlib.sha1(data).hexdigest() != h:
+                results.append((h, None, {}))
+                continue
+            typ = data.split(b' ', 1)[0].decode('ascii', 'replace')
+            results.append((h, typ, object_children(data)))
+        except Exception:
+            results.append((h, None, {}))
+    return results
+
+
+class CPUStage(object):
+    def __init__(self, workers, packs=None):
+        self.packs = packs
+        self.batch = Config.CPU_BATCH
+        # spawned, not forked: the walk's threads are running already and a
+        # fork copies whatever locks they hold
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init, initargs=(self._pack_files(), ))
+
+    def _pack_files(self):
+        if self.packs is None:
+            return []
+        return [(p.packpath, p.idxpath) for p in self.packs.packs]
+
+    def submit(self, batch):
+        return self._pool.submit(inspect, batch, self._pack_files())
+
+    def close(self):
+        self._pool.shutdown()
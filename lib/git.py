@@ -1,15 +1,27 @@
 import concurrent.futures
+import hashlib
 import os
 import subprocess
 import sys
 import threading
+import time
 import zlib
 
 from . import log
+from .cache import negative
 from .config import Config
-from .net import load_or_get, save_file
-from .parser import (find_sha1, parse_blob, parse_commit, parse_index,
-                     parse_tree)
+from .cpu import CPUStage
+from .metrics import metrics
+from .net import cached_download, fetch, load_or_get, save_chunks
+from .oid import ShaSet, to_hex, to_raw
+from .pack import (TYPE_NAMES, TYPE_NUMBERS, PackStore, check_pack,
+                   check_pack_index, find_pack_names, write_pack)
+from .parser import (index_trees, loose_chunks, object_children, parse_index,
+                     split_header, verify_object)
+from .refs import RefDiscovery, load_wordlist
+from .sched import INDEX_BLOB, REF, TREE, Scheduler
+from .state import WalkState, meta_path
+from .store import store
 
 
 def check_git():
@@ -41,6 +53,16 @@ def clone(cwd, url):
     return False
 
 
+def start_clone(cwd, url):
+    # a clone that can be cancelled, see GitScanner.race
+    cmd = ['git', 'clone', url, cwd]
+    return subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+
+
 def validate_repo(cwd):
     cmd = ['git', 'log']
     r = subprocess.run(cmd, cwd=cwd, capture_output=True)
@@ -52,113 +74,586 @@ def validate_repo(cwd):
     return False
 
 
+def recovered_any(localgit):
+    # whether a fake clone got anything at all: one object or the index
+    objects = os.path.join(localgit, 'objects')
+    for dirpath, dirnames, filenames in os.walk(objects):
+        if dirpath == objects and 'info' in dirnames:
+            dirnames.remove('info')
+        if any(not name.startswith('.') for name in filenames):
+            return True
+    try:
+        with open(os.path.join(localgit, 'index'), 'rb') as f:
+            return f.read(4) == b'DIRC'
+    except OSError:
+        return False
+
+
+def head_ref(data):
+    if not data:
+        return None
+    data = data.decode('utf-8', 'replace').strip()
+    if not data.startswith('ref:'):
+        # detached HEAD, its sha1 is seeded by RefDiscovery.feed (hash_cap)
+        return None
+    return data[4:].strip()
+
+
 def fake_clone(gitpair):
+    refs = RefDiscovery(load_wordlist(Config.REFS_FILE))
     with concurrent.futures.ThreadPoolExecutor(Config.THREADS) as executor:
-        sha1 = set()
-        sha1_lock = threading.Lock()
-
-        def _load(path, cover=False, hash_cap=False):
-            data = load_or_get(gitpair, path, cover)
-            if hash_cap:
-                sha1_lock.acquire()
-                h = find_sha1(data)
-                log.debug(f'{path}: {h}')
-                sha1.update(h)
-                sha1_lock.release()
-            return data
+        inflight = {}
+
+        def _submit(probes):
+            for path, cover, hash_cap in probes:
+                future = executor.submit(load_or_get, gitpair, path, cover)
+                inflight[future] = path, hash_cap
+
+        # probes run concurrently, what they reveal is probed in turn
+        _submit(refs.probes())
+        while inflight:
+            done, _ = concurrent.futures.wait(
+                inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path, hash_cap = inflight.pop(future)
+                try:
+                    _submit(refs.feed(path, future.result(), hash_cap))
+                except Exception as err:
+                    log.error(f'probe {path} failed: {err}')
+
+    log.info(f'refs: {len(refs.refs)} found, {len(refs.sha1)} seeds')
+    sha1 = refs.sha1
+    packnames = refs.packnames
+    sha1.update(index_seeds(gitpair))
+    state = WalkState(meta_path(gitpair, 'state.db'))
+    digest = walk_digest(gitpair, sha1, packnames)
+    if walk_unchanged(gitpair, state, digest, packnames):
+        log.info('refs unchanged since the last scan, skip walk')
+        metrics.counter('walk.skipped').inc()
+        state.close()
+        return
+    # unset until the walk completes, a rerun resumes it
+    state.set('walked', None)
+    packs = load_packs(gitpair, packnames)
+    try:
+        # the index restore is scheduled along with the walk, a blob both
+        # want is fetched once, see fetch_loose
+        hashes_walk(gitpair, sha1, packs, state, index_entries(gitpair))
+        state.set('walked', digest)
+    finally:
+        state.close()
+        packs.close()
+
+
+def walk_digest(gitpair, seeds, packnames):
+    # what the walk and the index restore start from
+    localgit, _ = gitpair
+    digest = hashlib.sha1()
+    for name in sorted(seeds) + sorted(packnames):
+        digest.update(name.encode() + b'\n')
+    indexpath = os.path.join(localgit, 'index')
+    if os.path.exists(indexpath) and os.path.getsize(indexpath) >= 20:
+        with open(indexpath, 'rb') as f:
+            # the index trailer is a sha1 over the whole file
+            f.seek(-20, os.SEEK_END)
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def walk_unchanged(gitpair, state, digest, packnames=()):
+    # same start as the last complete walk, every pack it had still there
+    # and every object it missed a permanent miss not worth asking for again
+    if state.get('walked') != digest:
+        return False
+    packdir = pack_dir(gitpair)
+    if not all(os.path.exists(os.path.join(packdir, name + '.pack'))
+               for name in packnames):
+        return False
+    _, netgit = gitpair
+    return all(f'{netgit}/objects/{h[:2]}/{h[2:]}' in negative
+               for h in state.missing())
+
+
+def index_seeds(gitpair):
+    # trees cached in the index are walked even if no ref points to them
+    localgit, _ = gitpair
+    indexpath = os.path.join(localgit, 'index')
+    if not os.path.exists(indexpath):
+        return set()
+    try:
+        seeds = {to_hex(h) for h in index_trees(indexpath)}
+    except Exception as err:
+        log.error(f'index extensions: {err}')
+        return set()
+    log.debug(f'index: {len(seeds)} cached trees')
+    return seeds
+
+
+def pack_dir(gitpair):
+    localgit, _ = gitpair
+    return os.path.join(localgit, 'objects', 'pack')
 
-        tasks = []
-
-        def _add_task(*args, **kwargs):
-            future = executor.submit(_load, *args, **kwargs)
-            tasks.append(future)
-            return future
-
-        future_head = _add_task('HEAD', cover=True)
-        _add_task('config', cover=True)
-        _add_task('description', cover=True)
-        _add_task('info/exclude', cover=True)
-        _add_task('refs/heads/master', hash_cap=True)
-        _add_task('refs/remotes/origin/master', hash_cap=True)
-        _add_task('refs/remotes/origin/HEAD', hash_cap=True)
-        _add_task('refs/stash', hash_cap=True)
-        _add_task('packed-refs', cover=True, hash_cap=True)
-        _add_task('logs/HEAD', hash_cap=True)
-        _add_task('logs/refs/heads/master', hash_cap=True)
-        _add_task('logs/refs/remotes/origin/master', hash_cap=True)
-        _add_task('logs/refs/remotes/origin/HEAD', hash_cap=True)
-        _add_task('FETCH_HEAD', hash_cap=True)
-        _add_task('ORIG_HEAD', hash_cap=True)
-        _add_task('COMMIT_EDITMSG')
-        _add_task('index')
-
-        refs = future_head.result()
-        if refs:
-            headpath = refs.decode('utf-8', 'replace').split(':')[1].strip()
-            _add_task(headpath, hash_cap=True)
-            _add_task('logs/' + headpath, hash_cap=True)
-
-        concurrent.futures.wait(tasks)
-
-    hashes_walk(gitpair, sha1)
-
-    index_extract(gitpair)
-
-
-def hashes_walk(gitpair, hashes):
-    hashpool = set(hashes)
-    usedhash = set()
-    while len(hashpool) > 0:
-        h = hashpool.pop()
-        if h in usedhash:
+
+def quarantine_pack(gitpair, name):
+    # a broken pack leaves objects/pack/, the next run fetches it again
+    qdir = meta_path(gitpair, 'quarantine')
+    os.makedirs(qdir, exist_ok=True)
+    for ext in ('.idx', '.pack'):
+        path = os.path.join(pack_dir(gitpair), name + ext)
+        if os.path.exists(path):
+            os.replace(path,
+                       os.path.join(qdir, f'{name}{ext}.{time.time_ns()}'))
+    metrics.counter('verify.corrupt').inc()
+
+
+def open_packs(gitpair, names):
+    packdir = pack_dir(gitpair)
+    if os.path.isdir(packdir):
+        # packs left by a previous run
+        names = names | find_pack_names(' '.join(os.listdir(packdir)))
+
+    packs = PackStore()
+    for name in sorted(names):
+        packpath = os.path.join(packdir, name + '.pack')
+        idxpath = os.path.join(packdir, name + '.idx')
+        if not (os.path.exists(packpath) and os.path.exists(idxpath)):
             continue
-        zdata = load_or_get(gitpair, f'objects/{h[:2]}/{h[2:]}')
         try:
-            data = zlib.decompress(zdata)
-            if data.startswith(b'tree'):
-                log.info('detect tree: ' + h)
-                tree = parse_tree(data)
-                hashpool.update(t['sha1'] for t in tree)
-            elif data.startswith(b'commit'):
-                log.info('detect commit: ' + h)
-                commit = parse_commit(data)
-                if commit['tree']:
-                    hashpool.add(commit['tree'])
-                if commit['parent']:
-                    hashpool.add(commit['parent'])
-            elif data.startswith(b'blob'):
-                log.info('detect blob: ' + h)
+            # the pack trailer is checked against its index, not hashed
+            if not check_pack_index(idxpath, packpath):
+                raise ValueError('index and pack do not match')
+            pack = packs.add(packpath, idxpath)
+            log.info(f'load pack: {name} ({len(pack)} objects)')
+        except Exception as err:
+            log.error(f'load pack {name} failed: {err}, quarantined')
+            quarantine_pack(gitpair, name)
+    return packs
+
+
+def pack_check(path, idxpath=None):
+    # a stream_download check for objects/pack/ files: an error page or a
+    # cut-off transfer must not take the name of a pack
+    def _check(partpath):
+        if path.endswith('.idx'):
+            ok = check_pack_index(partpath)
+        else:
+            ok = check_pack(partpath, idxpath)
+        if not ok:
+            log.error(f'broken pack file: {path}')
+            metrics.counter('verify.corrupt').inc()
+        return ok
+
+    return _check
+
+
+def load_packs(gitpair, names):
+    def _fetch(name):
+        path = f'objects/pack/{name}'
+        if fetch(gitpair, path + '.idx', check=pack_check(path + '.idx')):
+            idxpath = os.path.join(pack_dir(gitpair), name + '.idx')
+            fetch(gitpair, path + '.pack',
+                  check=pack_check(path + '.pack', idxpath))
+
+    with concurrent.futures.ThreadPoolExecutor(Config.THREADS) as executor:
+        list(executor.map(_fetch, names))
+    return open_packs(gitpair, names)
+
+
+class LoosePacker(object):
+    # moves walked loose objects into local packs Config.PACK_BATCH at a
+    # time, a big walk then leaves a few packs instead of a file per object;
+    # packs is the walk's PackStore, a new pack joins it before the loose
+    # files go
+    def __init__(self, gitpair, packs):
+        self.gitpair = gitpair
+        self.packs = packs
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def add(self, h):
+        # a full batch for write(), or None
+        with self._lock:
+            self._pending.append(h)
+            if len(self._pending) < Config.PACK_BATCH:
+                return None
+            batch, self._pending = self._pending, []
+        return batch
+
+    def close(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        self.write(batch)
+
+    def write(self, batch):
+        localgit, _ = self.gitpair
+        loose = {}
+        for h in batch:
+            localpath = os.path.join(localgit, 'objects', h[:2], h[2:])
+            if h not in self.packs and os.path.exists(localpath):
+                loose[h] = localpath
+        if not loose:
+            return
+
+        def _objects():
+            for h, localpath in loose.items():
+                with open(localpath, 'rb') as f:
+                    data = zlib.decompress(f.read())
+                header, body = data.split(b'\x00', 1)
+                typ = header.split(b' ', 1)[0]
+                yield to_raw(h), TYPE_NUMBERS[typ], body
+
+        try:
+            with metrics.time('phase.pack'):
+                packpath, idxpath = write_pack(
+                    pack_dir(self.gitpair), len(loose), _objects())
+                self.packs.add(packpath, idxpath)
+        except Exception as err:
+            # the objects stay loose, nothing is lost
+            log.error(f'pack {len(loose)} objects failed: {err}')
+            return
+        for localpath in loose.values():
+            try:
+                os.remove(localpath)
+            except FileNotFoundError:
                 pass
-            else:
-                log.warning('unknown file')
+        metrics.counter('pack.objects').inc(len(loose))
+        log.info(f'packed {len(loose)} objects into '
+                 f'{os.path.basename(packpath)}')
+
+
+def quarantine(gitpair, h, localpath):
+    # bad bodies are kept for a look but never reach objects/
+    qdir = meta_path(gitpair, 'quarantine')
+    os.makedirs(qdir, exist_ok=True)
+    os.replace(localpath, os.path.join(qdir, f'{h}.{time.time_ns()}'))
+    store.discard(f'objects/{h[:2]}/{h[2:]}')
+    metrics.counter('verify.corrupt').inc()
+
+
+def object_check(gitpair, h, rejected):
+    # a stream_download check, rejected bodies are appended to rejected
+    def _check(partpath):
+        if verify_object(h, partpath, Config.VERIFY):
+            return True
+        log.warning(f'corrupt object {h}, quarantined')
+        quarantine(gitpair, h, partpath)
+        rejected.append(partpath)
+        return False
+
+    return _check
+
+
+def verify_backoff(attempt):
+    # a WAF or an overloaded server may answer properly later
+    return Config.VERIFY_BACKOFF * 2**(attempt - 1) if attempt else 0
+
+
+def download_object(gitpair, h, check=True):
+    # check=False leaves verifying to the cpu stage, see hashes_walk
+    localgit, netgit = gitpair
+    path = f'objects/{h[:2]}/{h[2:]}'
+    localpath = os.path.join(localgit, path)
+    for attempt in range(Config.VERIFY_RETRIES + 1):
+        time.sleep(verify_backoff(attempt))
+        rejected = []
+        cached_download(path, localpath, f'{netgit}/{path}',
+                        object_check(gitpair, h, rejected) if check else None)
+        if os.path.exists(localpath):
+            return localpath
+        if not rejected:
+            # a plain miss, retrying won't help
+            return None
+    log.error(f'object {h} still corrupt after {attempt + 1} attempts')
+    return None
+
+
+_downloads = {}
+_downloads_lock = threading.Lock()
+
+
+def fetch_loose(gitpair, h, check=True):
+    localgit, _ = gitpair
+    localpath = os.path.join(localgit, 'objects', h[:2], h[2:])
+    if os.path.exists(localpath):
+        metrics.counter('fetch.reused').inc()
+        return localpath
+    # concurrent callers for one object share a single download
+    with _downloads_lock:
+        if os.path.exists(localpath):
+            metrics.counter('fetch.reused').inc()
+            return localpath
+        pending = _downloads.get(localpath)
+        if pending is None:
+            future = _downloads[localpath] = concurrent.futures.Future()
+    if pending is not None:
+        metrics.counter('fetch.shared').inc()
+        return pending.result()
+    found = None
+    try:
+        found = download_object(gitpair, h, check)
+    finally:
+        with _downloads_lock:
+            del _downloads[localpath]
+        future.set_result(found)
+    return found
+
+
+def object_body(first, chunks):
+    yield first
+    yield from chunks
+
+
+def open_object(gitpair, h, packs=None):
+    # (type, size, body chunks), a loose object is inflated as it is read
+    if packs is not None:
+        obj = packs.read(h)
+        if obj is not None:
+            typ, body = obj
+            return TYPE_NAMES[typ], len(body), object_body(body, ())
+    localpath = fetch_loose(gitpair, h)
+    if localpath is None:
+        raise FileNotFoundError('object not found: ' + h)
+    chunks = loose_chunks(localpath)
+    try:
+        typ, size, first = split_header(chunks)
+    except Exception:
+        chunks.close()
+        raise
+    return typ, size, object_body(first, chunks)
+
+
+def read_object(gitpair, h, packs=None):
+    if packs is not None:
+        data = packs.read_raw(h)
+        if data is not None:
+            return data
+    typ, size, body = open_object(gitpair, h)
+    return typ + b' %d\x00' % size + b''.join(body)
+
+
+def log_object(h, typ, scope=None):
+    if typ in {'tree', 'commit', 'blob', 'tag'}:
+        log.summary('walk', scope).add(typ, f'detect {typ}: {h}')
+    else:
+        log.warning('unknown file')
+
+
+def parse_object(h, data, scope=None):
+    typ = data.split(b' ', 1)[0].decode('ascii', 'replace')
+    log_object(h, typ, scope)
+    return object_children(data)
+
+
+def walk_object(gitpair, h, packs=None):
+    # (type, children), type is None when the object can't be read
+    localgit, _ = gitpair
+    localpath = os.path.join(localgit, 'objects', h[:2], h[2:])
+    for retry in (True, False):
+        try:
+            typ, size, body = open_object(gitpair, h, packs)
+            if typ == b'blob':
+                # blobs have no children, don't inflate them
+                body.close()
+                log_object(h, 'blob', localgit)
+                return 'blob', {}
+            # the object is local by now, this is inflate and parse time
+            with metrics.time('walk.parse'):
+                data = typ + b' %d\x00' % size + b''.join(body)
+                return typ.decode('ascii'), parse_object(h, data,
+                                                         localgit)
+        except (zlib.error, ValueError, AssertionError) as err:
+            # a corrupt file left by an older run, fetch it once more
+            if retry and os.path.exists(localpath) and not (
+                    packs is not None and h in packs):
+                log.warning(f'corrupt object {h}, quarantined')
+                quarantine(gitpair, h, localpath)
+                continue
+            log.error(err)
         except Exception as err:
             log.error(err)
-        usedhash.add(h)
+        return None, {}
+
 
+def fetch_object(gitpair, h, packs=None, attempt=0):
+    # network only, the cpu stage inflates and hashes: (found, local path
+    # or None when packed); attempt counts the copies the stage rejected
+    if packs is not None and h in packs:
+        return True, None
+    time.sleep(verify_backoff(attempt))
+    localpath = fetch_loose(gitpair, h, check=False)
+    return localpath is not None, localpath
 
-def index_extract(gitpair):
+
+def hashes_walk(gitpair, hashes, packs=None, state=None, entries=()):
+    # raw 20-byte ids inside the walk, hex only for urls, files and logs;
+    # index entries given are restored on the same threads, see Scheduler
     localgit, _ = gitpair
-    indexpath = os.path.join(localgit, 'index')
-    local = os.path.dirname(localgit)
-    entrys = parse_index(indexpath)
+    seeds = {to_raw(h) for h in hashes}
+    if state is None:
+        usedhash = ShaSet(seeds)
+        pending = list(usedhash)
+    else:
+        usedhash, pending = state.frontier(hashes)
+        if len(usedhash) > len(pending):
+            log.info(f'resume walk: {len(usedhash) - len(pending)} '
+                     f'objects done, {len(pending)} to go')
+    sched = Scheduler(Config.SIZE_ORDER)
+    for raw in pending:
+        # what a resumed walk left has lost its type, it may reveal more
+        sched.push(raw, REF if raw in seeds else TREE)
+    for entry in entries:
+        sched.push_entry(entry)
+
+    # with a cpu stage the threads only fetch, and inflating, sha1
+    # checks and parsing go to worker processes in batches
+    stage = CPUStage(Config.CPU_WORKERS, packs) if Config.CPU_WORKERS else None
+    ready = []
+    # copies of a sha1 the stage rejected
+    attempts = {}
+    packer = None
+    if Config.PACK and packs is not None:
+        packer = LoosePacker(gitpair, packs)
 
-    index = entrys.send(None)  #start
+    def _packed(h):
+        batch = packer.add(h) if packer else None
+        if batch:
+            packer.write(batch)
 
-    def _restore_blob(entry):
+    def _visited(h, typ, children):
+        metrics.counter('walk.objects').inc()
+        if typ is None:
+            metrics.counter('walk.missing').inc()
+        else:
+            _packed(h)
+        if state is not None:
+            state.record(h, typ, children)
+        for child, priority in children.items():
+            if usedhash.add(child):
+                sched.push(child, priority)
+
+    with metrics.time('phase.walk'), \
+            concurrent.futures.ThreadPoolExecutor(Config.THREADS) as executor:
+        inflight = {}
+        fetching = 0
         try:
-            h = entry['sha1']
-            n = entry['name']
-            zdata = load_or_get(gitpair, f'objects/{h[:2]}/{h[2:]}')
-            data = zlib.decompress(zdata)
-            blob = parse_blob(data)
-            save_file(os.path.join(local, n), blob['data'])
-        except Exception as err:
-            log.error(f'restore {n} failed: {err}')
+            while sched or inflight or ready:
+                # keep at most Config.THREADS fetches in flight, the most
+                # useful first
+                while sched and fetching < Config.THREADS:
+                    priority, item = sched.pop()
+                    if priority == INDEX_BLOB:
+                        future = executor.submit(restore_entry, gitpair, item,
+                                                 packs)
+                    elif stage:
+                        item = to_hex(item)
+                        future = executor.submit(fetch_object, gitpair, item,
+                                                 packs)
+                    else:
+                        item = to_hex(item)
+                        future = executor.submit(walk_object, gitpair, item,
+                                                 packs)
+                    inflight[future] = priority, item
+                    fetching += 1
+                if ready and (len(ready) >= stage.batch or not fetching):
+                    inflight[stage.submit(ready)] = None, dict(ready)
+                    ready = []
+                done, _ = concurrent.futures.wait(
+                    inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    priority, h = inflight.pop(future)
+                    if priority is None:
+                        localpaths = h
+                        for h, typ, children in future.result():
+                            localpath = localpaths[h]
+                            if typ is None and localpath:
+                                # the stage is the only check of a loose
+                                # object, a bad copy is fetched again
+                                log.warning(f'corrupt object {h}, quarantined')
+                                if os.path.exists(localpath):
+                                    quarantine(gitpair, h, localpath)
+                                attempts[h] = attempts.get(h, 0) + 1
+                                if attempts[h] <= Config.VERIFY_RETRIES:
+                                    inflight[executor.submit(
+                                        fetch_object, gitpair, h, packs,
+                                        attempts[h])] = TREE, h
+                                    fetching += 1
+                                    continue
+                                log.error(f'object {h} still corrupt after '
+                                          f'{attempts[h]} attempts')
+                            elif typ is None:
+                                log.error(f'broken object: {h}')
+                            else:
+                                log_object(h, typ, localgit)
+                            _visited(h, typ, children)
+                        continue
+                    fetching -= 1
+                    if priority == INDEX_BLOB:
+                        ok = future.result()
+                        restored(h, ok, localgit)
+                        if ok:
+                            _packed(to_hex(h.sha1))
+                        continue
+                    if not stage:
+                        _visited(h, *future.result())
+                        continue
+                    found, localpath = future.result()
+                    if found:
+                        ready.append((h, localpath))
+                    else:
+                        log.error(f'object not found: {h}')
+                        _visited(h, None, {})
+        finally:
+            if stage:
+                stage.close()
+            if packer:
+                packer.close()
+            log.summary('walk', localgit).close()
+            log.summary('index', localgit).close()
+    return usedhash
 
-    with concurrent.futures.ThreadPoolExecutor(Config.THREADS) as executor:
-        tasks = {executor.submit(_restore_blob, e): e for e in entrys}
-        for future in concurrent.futures.as_completed(tasks):
-            e = tasks[future]
-            h = e['sha1']
-            n = e['name']
-            log.info(f'restore blob: {h} => {n}')
+
+def restore_blob(gitpair, h, localpath, packs=None):
+    typ, size, body = open_object(gitpair, h, packs)
+    if typ != b'blob':
+        body.close()
+        raise ValueError(f'{h} is a {typ.decode()}, not a blob')
+    save_chunks(localpath, body)
+
+
+def index_entries(gitpair):
+    # the checked out snapshot, restored while the walk runs
+    localgit, _ = gitpair
+    indexpath = os.path.join(localgit, 'index')
+    if not os.path.exists(indexpath):
+        log.failure('index not found, skip restoring files')
+        return []
+    try:
+        entrys = parse_index(indexpath)
+        entrys.send(None)  # header
+        return list(entrys)
+    except Exception as err:
+        # a waf page or a cut-off transfer, the walk goes on without it
+        log.error(f'index: {err}')
+        return []
+
+
+def restore_entry(gitpair, entry, packs=None):
+    localgit, _ = gitpair
+    n = entry.name
+    try:
+        restore_blob(gitpair, to_hex(entry.sha1),
+                     os.path.join(os.path.dirname(localgit), n), packs)
+        metrics.counter('index.files').inc()
+        return True
+    except Exception as err:
+        metrics.counter('index.errors').inc()
+        log.error(f'restore {n} failed: {err}')
+        return False
+
+
+def restored(entry, ok, scope=None):
+    if ok and not metrics.value('index.first_file'):
+        metrics.timer('index.first_file').add(time.time() - metrics.started)
+    h = to_hex(entry.sha1)
+    log.summary('index', scope).add('blob',
+                                    f'restore blob: {h} => {entry.name}')
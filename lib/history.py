@@ -0,0 +1,158 @@
+import concurrent.futures
+import functools
+import os
+import shutil
+import threading
+
+from . import log
+from .config import Config
+from .git import open_packs, read_object, restore_blob
+from .oid import ShaSet, to_hex, to_raw
+from .parser import (GITLINK, TREE_MODES, find_sha1, parse_commit, parse_tag,
+                     parse_tree)
+
+# files and directories whose sha1s point at commits
+REF_FILES = ['HEAD', 'ORIG_HEAD', 'FETCH_HEAD', 'packed-refs']
+REF_DIRS = ['refs', 'logs']
+
+
+def ref_sha1s(localgit):
+    sha1 = set()
+    paths = [os.path.join(localgit, f) for f in REF_FILES]
+    for d in REF_DIRS:
+        for root, _, files in os.walk(os.path.join(localgit, d)):
+            paths.extend(os.path.join(root, f) for f in files)
+    for path in paths:
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                sha1.update(find_sha1(f.read()))
+    return sha1
+
+
+def commit_graph(gitpair, seeds, packs=None):
+    # [(commit, tree)] of every commit reachable from seeds, all parents
+    # of merges included; tags are peeled, other objects ignored
+    visited = ShaSet()
+    pending = [to_raw(h) for h in seeds]
+    commits = []
+    while pending:
+        raw = pending.pop()
+        if not visited.add(raw):
+            continue
+        h = to_hex(raw)
+        try:
+            data = read_object(gitpair, h, packs)
+        except Exception as err:
+            log.debug(f'history: skip {h}: {err}')
+            continue
+        if data.startswith(b'tag'):
+            tagged = parse_tag(data)
+            if tagged:
+                pending.append(to_raw(tagged))
+        elif data.startswith(b'commit'):
+            commit = parse_commit(data)
+            commits.append((h, commit['tree']))
+            pending.extend(to_raw(p) for p in commit['parent'])
+    return commits
+
+
+def safe_name(name):
+    # tree entries come from an untrusted server, never let one escape the
+    # snapshot directory or plant a .git
+    return (name not in {'', '.', '..'} and name.lower() != '.git' and
+            '/' not in name and '\\' not in name and '\x00' not in name)
+
+
+def link_file(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # no hardlinks across devices or on some filesystems
+        shutil.copyfile(src, dst)
+
+
+class History(object):
+    def __init__(self, gitpair, packs=None):
+        self.gitpair = gitpair
+        localgit, _ = gitpair
+        self.root = os.path.join(os.path.dirname(localgit), 'history')
+        # content-addressed store, every snapshot hardlinks its blobs here
+        self.store = os.path.join(self.root, '.objects')
+        self.packs = packs
+        # unchanged subtrees are shared by most commits, parse them once
+        self.tree_entries = functools.lru_cache(maxsize=4096)(self._entries)
+
+    def _entries(self, h):
+        return list(parse_tree(read_object(self.gitpair, h, self.packs)))
+
+    def blob(self, h):
+        path = os.path.join(self.store, h[:2], h[2:])
+        if not os.path.exists(path):
+            # racing threads may restore the same blob, the rename is atomic
+            partpath = f'{path}.{threading.get_ident()}.part'
+            try:
+                restore_blob(self.gitpair, h, partpath, self.packs)
+                os.replace(partpath, path)
+            finally:
+                if os.path.exists(partpath):
+                    os.remove(partpath)
+        return path
+
+    def checkout(self, tree, outdir):
+        # symlinks are stored as files holding their target, like git
+        # does with core.symlinks=false
+        stack = [(tree, outdir)]
+        while stack:
+            h, d = stack.pop()
+            os.makedirs(d, exist_ok=True)
+            for entry in self.tree_entries(h):
+                if not safe_name(entry.name):
+                    log.warning(f'history: unsafe path {entry.name!r}')
+                    continue
+                path = os.path.join(d, entry.name)
+                if entry.mode in TREE_MODES:
+                    stack.append((to_hex(entry.sha1), path))
+                elif entry.mode == GITLINK:
+                    os.makedirs(path, exist_ok=True)
+                else:
+                    try:
+                        link_file(self.blob(to_hex(entry.sha1)), path)
+                    except Exception as err:
+                        log.error(f'restore {path} failed: {err}')
+
+    def restore(self, commit, tree):
+        outdir = os.path.join(self.root, commit)
+        if os.path.isdir(outdir):
+            log.debug('reuse snapshot: ' + commit)
+            return False
+        # a snapshot only appears once complete
+        partdir = outdir + '.part'
+        shutil.rmtree(partdir, ignore_errors=True)
+        self.checkout(tree, partdir)
+        os.replace(partdir, outdir)
+        return True
+
+
+def restore_history(gitpair):
+    localgit, _ = gitpair
+    packs = open_packs(gitpair, set())
+    try:
+        commits = commit_graph(gitpair, ref_sha1s(localgit), packs)
+        log.info(f'history: {len(commits)} commits')
+        history = History(gitpair, packs)
+        with concurrent.futures.ThreadPoolExecutor(Config.THREADS) as executor:
+            tasks = {
+                executor.submit(history.restore, commit, tree): commit
+                for commit, tree in commits
+            }
+            for future in concurrent.futures.as_completed(tasks):
+                commit = tasks[future]
+                try:
+                    if future.result():
+                        log.summary('history', localgit).add(
+                            'commit', 'restore commit: ' + commit)
+                except Exception as err:
+                    log.error(f'restore commit {commit} failed: {err}')
+    finally:
+        log.summary('history', localgit).close()
+        packs.close()
@@ -0,0 +1,140 @@
+import asyncio
+import email.utils
+import threading
+import time
+import urllib.parse
+
+from .config import Config
+
+
+class Limiter(object):
+    def __init__(self, size=None):
+        self.size = size
+        self.active = 0
+        self.pause_until = 0
+        self._cond = threading.Condition()
+
+    def _full(self):
+        return self.size and self.active >= self.size
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                pause = self.pause_until - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                elif self._full():
+                    self._cond.wait()
+                else:
+                    break
+            self.active += 1
+
+    def try_acquire(self):
+        with self._cond:
+            if self.pause_until > time.monotonic() or self._full():
+                return False
+            self.active += 1
+            return True
+
+    async def acquire_async(self):
+        # the limiter is shared with plain threads, so poll instead of
+        # blocking the event loop
+        while not self.try_acquire():
+            await asyncio.sleep(0.01)
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def resize(self, size):
+        with self._cond:
+            self.size = size
+            self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, typ, value, trace):
+        self.release()
+
+
+# AIMD window: grow by one request per window while latency is stable,
+# halve on timeouts, 429 and 503, and pause for Retry-After
+class AdaptiveLimiter(Limiter):
+    THROTTLED = {429, 503}
+
+    def __init__(self, floor, ceiling, start=None):
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.window = float(min(max(start or self.floor, self.floor),
+                                self.ceiling))
+        self.rtt = None
+        self._last_drop = 0
+        Limiter.__init__(self, int(self.window))
+
+    def feedback(self, latency=None, status=None, retry_after=None):
+        now = time.monotonic()
+        with self._cond:
+            if status is None or status in self.THROTTLED:
+                if retry_after:
+                    self.pause_until = max(self.pause_until, now + retry_after)
+                # a burst of errors within one round trip is one event
+                if now - self._last_drop > (self.rtt or 0):
+                    self.window = max(self.floor, self.window / 2)
+                    self._last_drop = now
+            elif latency is not None:
+                if self.rtt is None:
+                    self.rtt = latency
+                elif latency < self.rtt * 2:
+                    self.window = min(self.ceiling,
+                                      self.window + 1 / self.window)
+                self.rtt = self.rtt * 0.8 + latency * 0.2
+            self.size = int(self.window)
+            self._cond.notify_all()
+
+
+def parse_retry_after(value, cap=120):
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        delay = date.timestamp() - time.time()
+    return min(max(delay, 0), cap)
+
+
+# requests in flight over every target of the process
+budget = Limiter()
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+
+def host(netpath):
+    hostname = urllib.parse.urlsplit(netpath).hostname
+    with _hosts_lock:
+        limiter = _hosts.get(hostname)
+        if limiter is None:
+            limiter = _hosts[hostname] = AdaptiveLimiter(
+                Config.MIN_THREADS, host_ceiling(), Config.START_THREADS)
+        return limiter
+
+
+def host_ceiling():
+    if Config.HOST_LIMIT:
+        return Config.HOST_LIMIT
+    if Config.ENGINE == 'async':
+        return Config.ASYNC_LIMIT
+    return Config.THREADS
+
+
+def configure():
+    budget.resize(Config.GLOBAL_LIMIT)
+    with _hosts_lock:
+        _hosts.clear()
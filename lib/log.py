@@ -1,6 +1,10 @@
+import atexit
+import collections
 import itertools
 import logging
+import logging.handlers
 import os
+import queue
 import threading
 import time
 from getpass import getpass
@@ -13,9 +17,11 @@ except ImportError:
 
 __all__ = [
     'critical', 'debug', 'error', 'info', 'warning', 'success', 'failure',
-    'basicConfig', 'RunningBar'
+    'detail', 'summary', 'basicConfig', 'RunningBar'
 ]
 
+# per-object lines: in the --log file, collapsed on the console
+DETAIL = logging.INFO - 5
 SUCCESS = logging.INFO + 5
 FAILURE = logging.WARNING + 5
 
@@ -31,6 +37,7 @@ if not colorlog is None:
         '[%(log_color)s%(levelname)s%(reset)s] %(message)s')
     color.log_colors = {
         'DEBUG': 'bold_red',
+        'DETAIL': 'blue',
         'INFO': 'bold_blue',
         'SUCCESS': 'bold_green',
         'WARNING': 'bold_yellow',
@@ -46,14 +53,20 @@ verbose = logging.Formatter(
 )
 
 
-def basicConfig(is_no_color=False, log_file_path=None, level=logging.INFO):
+def basicConfig(is_no_color=False,
+                log_file_path=None,
+                level=logging.INFO,
+                queued=True):
+    # queued: worker threads only enqueue records, formatting and console
+    # or file i/o happen in one background thread
+    handlers = []
     if log_file_path:
         file = logging.FileHandler(log_file_path, encoding='utf-8')
 
+    logging.addLevelName(DETAIL, 'DETAIL')
     logging.addLevelName(SUCCESS, 'SUCCESS')
     logging.addLevelName(FAILURE, 'FAILURE')
     root_logger = logging.root
-    root_logger.setLevel(logging.NOTSET)
 
     console.setLevel(level)
     if is_no_color:
@@ -61,12 +74,26 @@ def basicConfig(is_no_color=False, log_file_path=None, level=logging.INFO):
         RunningBar.move = False
     else:
         console.setFormatter(color)
-    root_logger.addHandler(console)
+    handlers.append(console)
 
     if log_file_path:
         file.setLevel(logging.DEBUG)
         file.setFormatter(verbose)
-        root_logger.addHandler(file)
+        handlers.append(file)
+
+    # records no handler wants are dropped at the call site
+    root_logger.setLevel(min(h.level for h in handlers))
+    if queued:
+        records = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(
+            records, *handlers, respect_handler_level=True)
+        listener.start()
+        # runs before logging's own shutdown, atexit is last in first out
+        atexit.register(listener.stop)
+        root_logger.addHandler(logging.handlers.QueueHandler(records))
+    else:
+        for handler in handlers:
+            root_logger.addHandler(handler)
 
 
 def success(msg, *args, **kwargs):
@@ -77,8 +104,66 @@ def failure(msg, *args, **kwargs):
     logging.log(FAILURE, msg, *args, **kwargs)
 
 
+def detail(msg, *args, **kwargs):
+    logging.log(DETAIL, msg, *args, **kwargs)
+
+
+class Summary(object):
+    # counts per-item events and logs one INFO line for them every few
+    # seconds, the items themselves only go out at DETAIL
+    interval = 2
+
+    def __init__(self, name, key=None):
+        self.name = name
+        self._key = key or name
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._last = time.monotonic()
+
+    def add(self, kind, msg=None):
+        if msg is not None:
+            logging.log(DETAIL, msg)
+        with self._lock:
+            self.counts[kind] += 1
+            now = time.monotonic()
+            if now - self._last < self.interval:
+                return
+            self._last = now
+            line = self._line()
+        logging.info(line)
+
+    def _line(self):
+        kinds = ', '.join(f'{k} {n}' for k, n in sorted(self.counts.items()))
+        return f'{self.name}: {sum(self.counts.values())} ({kinds})'
+
+    def close(self):
+        with _summaries_lock:
+            if _summaries.get(self._key) is self:
+                del _summaries[self._key]
+        with self._lock:
+            if self.counts:
+                logging.info(self._line())
+
+
+_summaries = {}
+_summaries_lock = threading.Lock()
+
+
+def summary(name, scope=None):
+    # the open summary of a phase, close() logs its totals and ends it;
+    # scope keeps the phases of targets scanned at once apart
+    key = (name, scope)
+    with _summaries_lock:
+        s = _summaries.get(key)
+        if s is None:
+            s = _summaries[key] = Summary(name, key)
+        return s
+
+
 class RunningBar(threading.Thread):
     move = True
+    # optional callable returning a live progress line, see --progress
+    status = None
 
     def __init__(self, msg):
         threading.Thread.__init__(self)
@@ -111,11 +196,16 @@ class RunningBar(threading.Thread):
     def run(self):
         start = time.perf_counter()
         if self.move:
+            width = 0
             while True:
                 frame = next(self.anime)
+                line = f'[{self.name}] {self.msg} {frame}'
+                if self.status:
+                    line += ' ' + self.status()
+                # a shorter line must not leave the tail of the last one
+                width = max(width, len(line))
                 console.acquire()
-                print(
-                    f'[{self.name}] {self.msg} {frame}', end='\r', flush=True)
+                print(line.ljust(width), end='\r', flush=True)
                 console.release()
                 if self._stop_event.wait(0.1):
                     break
@@ -128,4 +218,6 @@ class RunningBar(threading.Thread):
         self._stop_event.set()
         self.join()
         end = f'{self.msg} (done in {self.elapsed}s)'
+        if self.status:
+            end += ' ' + self.status()
         logging.info(end)
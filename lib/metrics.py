@@ -0,0 +1,150 @@
+import bisect
+import json
+import threading
+import time
+
+# latency buckets in seconds, 1ms doubling up to ~65s
+BUCKETS = [0.001 * 2**i for i in range(17)]
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th value
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, round(self.max, 6))
+        return round(self.max, 6)
+
+    def snapshot(self):
+        with self._lock:
+            if not self.count:
+                return {'count': 0}
+            return {
+                'count': self.count,
+                'sum': round(self.sum, 6),
+                'mean': round(self.sum / self.count, 6),
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'max': round(self.max, 6),
+            }
+
+
+class Timer(object):
+    # wall time of a phase; phases may overlap and run in several threads
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.calls += 1
+            self.seconds += seconds
+
+    def snapshot(self):
+        return {'calls': self.calls, 'seconds': round(self.seconds, 6)}
+
+
+class _Timing(object):
+    def __init__(self, timer):
+        self.timer = timer
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, typ, value, trace):
+        self.timer.add(time.perf_counter() - self.start)
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def _get(self, name, cls):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(name, cls())
+        return metric
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def histogram(self, name):
+        return self._get(name, Histogram)
+
+    def timer(self, name):
+        return self._get(name, Timer)
+
+    def time(self, name):
+        # with metrics.time('phase.walk'): ...
+        return _Timing(self.timer(name))
+
+    def value(self, name):
+        metric = self._metrics.get(name)
+        return metric.snapshot() if metric is not None else 0
+
+    def snapshot(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+        return {
+            'started': self.started,
+            'elapsed': round(time.time() - self.started, 3),
+            'metrics': {
+                name: metric.snapshot()
+                for name, metric in sorted(metrics.items())
+            },
+        }
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def progress(self):
+        # one line for RunningBar: totals and rates since the start
+        elapsed = max(time.time() - self.started, 1e-6)
+        requests = self.value('http.requests')
+        size = self.value('http.bytes') / 1024 / 1024
+        objects = self.value('walk.objects')
+        return (f'{requests} req ({requests / elapsed:.0f}/s) '
+                f'{size:.1f}MB ({size / elapsed:.2f}MB/s) '
+                f'{objects} obj ({objects / elapsed:.0f}/s)')
+
+
+metrics = Registry()
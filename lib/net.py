@@ -1,13 +1,24 @@
+import codecs
 import concurrent.futures
+import html.parser
+import http.client
 import logging
 import os
+import queue
 import random
-import re
+import ssl
+import tempfile
+import threading
 import time
-import urllib.error
+import urllib.parse
 import urllib.request
+import zlib
 
+from . import limit
+from .cache import negative, validators
 from .config import Config
+from .metrics import metrics
+from .store import store
 
 with open(Config.UA_FILE) as f:
     _ua = list(u.strip() for u in f.readlines())
@@ -25,6 +36,15 @@ def save_file(localpath, data):
         f.write(data)
 
 
+def save_chunks(localpath, chunks):
+    dirname = os.path.dirname(localpath)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(localpath, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
 def load_file(localpath):
     if os.path.exists(localpath):
         with open(localpath, 'rb') as f:
@@ -33,21 +53,320 @@ def load_file(localpath):
         return None
 
 
-def get(netpath, retry=3):
-    for _ in range(retry):
+class ConnectionPool(object):
+    def __init__(self, scheme, netloc, size):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.proxy = urllib.request.getproxies().get(scheme)
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        host = self.netloc
+        if self.proxy:
+            host = urllib.parse.urlsplit(self.proxy).netloc
+        if self.scheme == 'https':
+            conn = http.client.HTTPSConnection(
+                host,
+                timeout=Config.TIMEOUT,
+                context=ssl.create_default_context())
+            if self.proxy:
+                conn.set_tunnel(self.netloc)
+        else:
+            conn = http.client.HTTPConnection(host, timeout=Config.TIMEOUT)
+        return conn
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn, reuse=True):
+        if reuse:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def target(self, netpath):
+        # plain http proxies want the absolute url in the request line
+        if self.proxy and self.scheme == 'http':
+            return netpath
+        parts = urllib.parse.urlsplit(netpath)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        return path
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(netpath):
+    parts = urllib.parse.urlsplit(netpath)
+    key = (parts.scheme, parts.netloc)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            size = Config.POOL_SIZE or Config.THREADS
+            pool = _pools[key] = ConnectionPool(*key, size)
+        return pool
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+# returned by get() for a revalidated copy the server says is still current
+NOT_MODIFIED = object()
+
+
+def immutable_url(netpath):
+    # is_immutable for a full url
+    path = urllib.parse.urlsplit(netpath).path
+    return '/objects/' in path and '/objects/info/' not in path
+
+
+def request_headers(netpath, revalidate=False):
+    # objects are zlib streams already, text files shrink a lot
+    headers = {}
+    if immutable_url(netpath):
+        return headers
+    # 'deflate' is ambiguous (zlib or raw, iis sends raw), gzip is not
+    headers['Accept-Encoding'] = 'gzip'
+    if revalidate:
+        headers.update(validators.headers(netpath))
+    return headers
+
+
+def remember(netpath, headers):
+    # headers: any mapping with case-insensitive or lowercase keys
+    if not immutable_url(netpath):
+        validators.update(netpath, headers.get('etag'),
+                          headers.get('last-modified'))
+
+
+def body_decoder(encoding):
+    if not encoding or encoding.lower() == 'identity':
+        return None
+    if encoding.lower() not in {'gzip', 'x-gzip', 'deflate'}:
+        raise ValueError(f'unsupported content-encoding {encoding}')
+    metrics.counter('http.compressed').inc()
+    return BodyDecoder()
+
+
+class BodyDecoder(object):
+    # gzip or zlib header, detected from the first bytes; a stream that
+    # has neither is replayed as raw deflate
+    def __init__(self):
+        self._obj = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self._head = b''
+        self._sniffing = True
+
+    def decompress(self, data):
+        if not self._sniffing:
+            return self._obj.decompress(data)
+        self._head += data
         try:
-            req = urllib.request.Request(
-                netpath, headers={'User-Agent': rand_ua()})
-            with urllib.request.urlopen(req, timeout=Config.TIMEOUT) as conn:
-                return conn.read()
-        except urllib.error.HTTPError as err:
-            logging.debug(f'get {netpath} err: {err}')
+            out = self._obj.decompress(data)
+        except zlib.error:
+            self._sniffing = False
+            self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._obj.decompress(self._head)
+        if out:
+            self._sniffing = False
+            self._head = b''
+        return out
+
+    def flush(self):
+        return self._obj.flush()
+
+
+def read_into(resp, sink):
+    # a retried response starts over
+    sink.seek(0)
+    sink.truncate()
+    decoder = body_decoder(resp.getheader('Content-Encoding'))
+    while True:
+        chunk = resp.read(Config.CHUNK_SIZE)
+        if not chunk:
+            if decoder:
+                sink.write(decoder.flush())
+            return True
+        metrics.counter('http.bytes').inc(len(chunk))
+        sink.write(decoder.decompress(chunk) if decoder else chunk)
+
+
+def read_body(resp):
+    data = resp.read()
+    metrics.counter('http.bytes').inc(len(data))
+    decoder = body_decoder(resp.getheader('Content-Encoding'))
+    if decoder:
+        data = decoder.decompress(data) + decoder.flush()
+    return data
+
+
+def has_body(status):
+    # 1xx, 204 and 304 end at the blank line after the headers
+    return status >= 200 and status not in {204, 304}
+
+
+def cached_miss(netpath):
+    if netpath not in negative:
+        return False
+    logging.debug(f'get {netpath} skipped: cached miss')
+    metrics.counter('http.cached_misses').inc()
+    return True
+
+
+# what an idle connection the server has closed meanwhile fails with
+STALE_ERRORS = (http.client.BadStatusLine, BrokenPipeError,
+                ConnectionResetError)
+
+
+def is_stale(err, early):
+    # early: a reused connection that failed before any response bytes;
+    # a timeout is never stale, the host may be the one hanging
+    return early and isinstance(err, STALE_ERRORS)
+
+
+def request_failed(hostlimit, netpath, err, stale):
+    # whether the failed attempt counts against the retries
+    logging.debug(f'get {netpath} err: {err!r}')
+    metrics.counter('http.errors').inc()
+    if stale:
+        metrics.counter('http.stale').inc()
+        return False
+    hostlimit.feedback()
+    return True
+
+
+# what get() does with a response, shared by both engines
+DONE = 'done'
+REDIRECT = 'redirect'
+RETRY = 'retry'
+
+
+def handle_response(netpath, status, headers, body, latency, hostlimit,
+                    revalidate=False):
+    # headers: any mapping with case-insensitive or lowercase keys;
+    # returns (DONE, result), (REDIRECT, url) or (RETRY, None)
+    metrics.histogram('http.latency').observe(latency)
+    metrics.counter(f'http.status.{status}').inc()
+    retry_after = limit.parse_retry_after(headers.get('retry-after'))
+    hostlimit.feedback(latency, status, retry_after)
+    if status == 200:
+        remember(netpath, headers)
+        return DONE, body
+    if status == 304 and revalidate:
+        metrics.counter('http.not_modified').inc()
+        return DONE, NOT_MODIFIED
+    location = headers.get('location')
+    if status in {301, 302, 303, 307, 308} and location:
+        return REDIRECT, urllib.parse.urljoin(netpath, location)
+    logging.debug(f'get {netpath} err: HTTP {status}')
+    if negative.add(netpath, status):
+        # a definitive miss, retrying won't change it
+        return DONE, None
+    metrics.counter('http.retries').inc()
+    return RETRY, None
+
+
+def get(netpath, retry=3, redirect=5, sink=None, revalidate=False):
+    if cached_miss(netpath):
+        return None
+    pool = get_pool(netpath)
+    hostlimit = limit.host(netpath)
+    headers = {'User-Agent': rand_ua(), 'Connection': 'keep-alive'}
+    headers.update(request_headers(netpath, revalidate))
+    while retry > 0:
+        with hostlimit, limit.budget:
+            conn = pool.acquire()
+            reused = conn.sock is not None
+            start = time.perf_counter()
+            metrics.counter('http.requests').inc()
+            resp = None
+            try:
+                conn.request('GET', pool.target(netpath), headers=headers)
+                resp = conn.getresponse()
+                if sink and resp.status == 200:
+                    data = read_into(resp, sink)
+                else:
+                    data = read_body(resp)
+            except (http.client.HTTPException, OSError, ValueError,
+                    zlib.error) as err:
+                pool.release(conn, False)
+                stale = is_stale(err, reused and resp is None)
+                if request_failed(hostlimit, netpath, err, stale):
+                    retry -= 1
+                continue
+            pool.release(conn, not resp.will_close)
+            latency = time.perf_counter() - start
+        action, result = handle_response(netpath, resp.status, resp.headers,
+                                         data, latency, hostlimit, revalidate)
+        if action == RETRY:
+            retry -= 1
+        elif action == REDIRECT:
+            if not redirect:
+                return None
+            return get(result, retry, redirect - 1, sink, revalidate)
+        else:
+            return result
     return None
 
 
+def stream_download(localpath, netpath, check=None):
+    # check(partpath) may reject the body before it takes localpath
+    logging.debug('download ' + netpath)
+    dirname = os.path.dirname(localpath)
+    os.makedirs(dirname, exist_ok=True)
+    fd, partpath = tempfile.mkstemp(dir=dirname, prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            ok = get(netpath, sink=f, revalidate=os.path.exists(localpath))
+        if ok is NOT_MODIFIED:
+            return True
+        if ok and check is not None:
+            ok = check(partpath)
+        if ok:
+            os.replace(partpath, localpath)
+    finally:
+        if os.path.exists(partpath):
+            os.remove(partpath)
+    return bool(ok)
+
+
+def cached_download(path, localpath, netpath, check=None):
+    # stream_download behind the object store, for paths named after their
+    # content; path is relative to the .git directory
+    if not is_immutable(path):
+        return stream_download(localpath, netpath, check)
+    if store.get(path, localpath):
+        return True
+    ok = stream_download(localpath, netpath, check)
+    if ok:
+        store.put(path, localpath)
+    return ok
+
+
 def download(localpath, netpath):
     logging.debug('download ' + netpath)
-    data = get(netpath)
+    data = get(netpath, revalidate=os.path.exists(localpath))
+    if data is NOT_MODIFIED:
+        return load_file(localpath)
     if data:
         save_file(localpath, data)
     return data
@@ -60,53 +379,172 @@ def load_or_get(basepair, path, cover=False):
 
     ret = None
     if cover or not os.path.exists(localpath):
-        ret = download(localpath, netpath)
+        if not (is_immutable(path) and store.get(path, localpath)):
+            ret = download(localpath, netpath)
+            if ret and is_immutable(path):
+                store.put(path, localpath)
+    else:
+        metrics.counter('fetch.reused').inc()
 
     return ret or load_file(localpath)
 
 
-def isdirlist(url):
-    keywords = [
-        'To Parent Directory',
-        'Index of /',
-        'Directory Listing For /',
-        '[转到父目录]',
-        'objects/',
-    ]
-    data = get(url)
+def fetch(basepair, path, cover=False, check=None):
+    # like load_or_get, but streams to disk and returns the local path
+    localbase, netbase = basepair
+    localpath = os.path.join(localbase, path)
+    netpath = f"{netbase.rstrip('/')}/{path.lstrip('/')}"
+
+    if cover or not os.path.exists(localpath):
+        cached_download(path, localpath, netpath, check)
+    else:
+        metrics.counter('fetch.reused').inc()
+
+    return localpath if os.path.exists(localpath) else None
+
+
+DIRLIST_KEYWORDS = [
+    'To Parent Directory',
+    'Index of /',
+    'Directory Listing For /',
+    '[转到父目录]',
+    'objects/',
+]
+
+
+def is_dirlist_page(data):
     if data:
         data = data.decode('utf-8', 'replace')
-        for key in keywords:
+        for key in DIRLIST_KEYWORDS:
             if key in data:
                 return True
     return False
 
 
+def isdirlist(url):
+    return is_dirlist_page(get(url))
+
+
+class LinkExtractor(html.parser.HTMLParser):
+    # every <a href> of a page, whatever the autoindex layout (apache and
+    # lighttpd tables, nginx and iis <pre>, python <ul>); fed chunk by
+    # chunk, so it can be the sink of get()
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            for name, value in attrs:
+                if name == 'href' and value:
+                    self.links.append(value)
+
+    def write(self, chunk):
+        self.feed(self._decoder.decode(chunk))
+
+    def seek(self, offset):
+        # get() starts a retried response over
+        self.reset()
+        self.links = []
+        self._decoder.reset()
+
+    def truncate(self):
+        pass
+
+    def close(self):
+        self.feed(self._decoder.decode(b'', final=True))
+        super().close()
+
+
+def dirlist_children(pageurl, links):
+    # direct children of the listed directory, dirs keep their trailing
+    # '/'; parent, sort (?C=N;O=D) and off-site links are dropped
+    children = []
+    for link in links:
+        url = urllib.parse.urljoin(pageurl, link).split('#', 1)[0]
+        if '?' in url or not url.startswith(pageurl):
+            continue
+        name = url[len(pageurl):]
+        if (name and '/' not in name.rstrip('/') and safe_child(name) and
+                name not in children):
+            children.append(name)
+    return children
+
+
+def safe_child(name):
+    # names are unquoted into local paths, '..%2f' must not climb out
+    name = urllib.parse.unquote(name.rstrip('/'))
+    return (name not in {'', '.', '..'} and '/' not in name and
+            '\\' not in name and '\x00' not in name)
+
+
+def dirlist_local(localbase, path):
+    # the local file of a listed path, never outside localbase
+    localbase = os.path.abspath(localbase)
+    localpath = os.path.abspath(
+        os.path.join(localbase, urllib.parse.unquote(path.strip('/'))))
+    if localpath != localbase and not localpath.startswith(localbase +
+                                                           os.sep):
+        raise ValueError(f'unsafe listed path: {path}')
+    return localpath
+
+
+def parse_dirlist(page, pageurl):
+    parser = LinkExtractor()
+    parser.write(page)
+    parser.close()
+    return dirlist_children(pageurl, parser.links)
+
+
+def is_immutable(path):
+    # loose objects and packs are named after their content
+    path = path.lstrip('/')
+    return path.startswith('objects/') and not path.startswith('objects/info/')
+
+
 def dirlist_spider(basepair):
-    dirlist_ptn = re.compile(br'<td>\s*<a href="([^"]+)', re.M | re.I)
     localbase, netbase = basepair
     localbase = localbase.rstrip('/')
     netbase = netbase.rstrip('/')
-    with concurrent.futures.ThreadPoolExecutor(Config.THREADS) as executor:
-        tasks = []
-
-        def recursive(path='/'):
-            localpath = os.path.join(localbase, path.strip('/'))
-            netpath = f"{netbase}/{path.lstrip('/')}"
-            if path.endswith('/'):
-                logging.debug('detect path: ' + path)
-                os.makedirs(localpath, exist_ok=True)
-                page = get(netpath)
-                if page:
-                    for _f in dirlist_ptn.findall(page):
-                        _f = _f.decode('utf-8', 'replace')
-                        if '../' == _f or _f.startswith('/'):
-                            continue
-                        recursive(f'{path}{_f}')
-            else:
-                logging.debug('detect file: ' + path)
-                tasks.append(executor.submit(download, localpath, netpath))
-                time.sleep(0.2)
-
-        recursive()
-        concurrent.futures.wait(tasks)
+
+    def _crawl(path):
+        # listings are fetched in parallel like files, the children found
+        # are fed back into the frontier by the caller
+        localpath = dirlist_local(localbase, path)
+        netpath = f"{netbase}/{path.lstrip('/')}"
+        if path.endswith('/'):
+            logging.debug('detect path: ' + path)
+            os.makedirs(localpath, exist_ok=True)
+            metrics.counter('dirlist.pages').inc()
+            parser = LinkExtractor()
+            if get(netpath, sink=parser):
+                parser.close()
+                return dirlist_children(netpath, parser.links)
+        elif is_immutable(path) and os.path.exists(localpath):
+            logging.debug('reuse file: ' + path)
+        else:
+            logging.debug('detect file: ' + path)
+            metrics.counter('dirlist.files').inc()
+            cached_download(path, localpath, netpath)
+        return []
+
+    with metrics.time('phase.dirlist'), \
+            concurrent.futures.ThreadPoolExecutor(Config.THREADS) as executor:
+        seen = {'/'}
+        inflight = {executor.submit(_crawl, '/'): '/'}
+        while inflight:
+            done, _ = concurrent.futures.wait(
+                inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path = inflight.pop(future)
+                try:
+                    children = future.result()
+                except Exception as err:
+                    logging.error(f'crawl {path} failed: {err}')
+                    continue
+                for name in children:
+                    child = path + name
+                    if child not in seen:
+                        seen.add(child)
+                        inflight[executor.submit(_crawl, child)] = child
@@ -0,0 +1,112 @@
+import binascii
+
+# object ids are kept as raw 20-byte sha1s, hexlified only at the edges
+# (urls, file names, logs)
+RAW_LEN = 20
+EMPTY = bytes(RAW_LEN)
+
+
+def to_raw(h):
+    return binascii.unhexlify(h) if isinstance(h, str) else bytes(h)
+
+
+def to_hex(raw):
+    return binascii.hexlify(raw).decode('ascii')
+
+
+class ShaSet(object):
+    # open addressing over a single bytearray of 20-byte slots, about 40
+    # bytes per id instead of ~150 for a 40-char str in a set; an all-zero
+    # slot is free, the all-zero sha1 is never a real object
+    def __init__(self, items=(), capacity=1024):
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self._size = size
+        self._table = bytearray(size * RAW_LEN)
+        self._len = 0
+        for raw in items:
+            self.add(raw)
+
+    def _find(self, raw):
+        mask = self._size - 1
+        # sha1s are uniformly distributed, their prefix is the hash
+        i = int.from_bytes(raw[:8], 'big') & mask
+        table = self._table
+        while True:
+            off = i * RAW_LEN
+            cur = table[off:off + RAW_LEN]
+            if cur == raw:
+                return off, True
+            if cur == EMPTY:
+                return off, False
+            i = (i + 1) & mask
+
+    def _grow(self):
+        old = self._table
+        self._size <<= 1
+        self._table = bytearray(self._size * RAW_LEN)
+        self._len = 0
+        for off in range(0, len(old), RAW_LEN):
+            raw = old[off:off + RAW_LEN]
+            if raw != EMPTY:
+                self.add(bytes(raw))
+
+    def add(self, raw):
+        # True when raw was not in the set yet
+        if len(raw) != RAW_LEN or raw == EMPTY:
+            raise ValueError('not a raw sha1: %r' % (raw, ))
+        off, found = self._find(raw)
+        if found:
+            return False
+        self._table[off:off + RAW_LEN] = raw
+        self._len += 1
+        if self._len * 3 > self._size * 2:
+            self._grow()
+        return True
+
+    def update(self, items):
+        for raw in items:
+            self.add(raw)
+
+    def __contains__(self, raw):
+        if len(raw) != RAW_LEN or raw == EMPTY:
+            return False
+        return self._find(raw)[1]
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        table = self._table
+        for off in range(0, len(table), RAW_LEN):
+            raw = table[off:off + RAW_LEN]
+            if raw != EMPTY:
+                yield bytes(raw)
+
+
+class ShaStack(object):
+    # LIFO of raw sha1s packed back to back in one bytearray
+    def __init__(self, items=()):
+        self._data = bytearray()
+        for raw in items:
+            self.push(raw)
+
+    def push(self, raw):
+        self._data += raw
+
+    def pop(self):
+        raw = bytes(self._data[-RAW_LEN:])
+        del self._data[-RAW_LEN:]
+        return raw
+
+    def __len__(self):
+        return len(self._data) // RAW_LEN
+
+    def __iter__(self):
+        # drains the stack
+        while self._data:
+            yield self.pop()
+
+    def __bool__(self):
+        return bool(self._data)
@@ -0,0 +1,438 @@
+import collections
+import hashlib
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import zlib
+
+from .config import Config
+from .oid import RAW_LEN, to_hex, to_raw
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NAMES = {
+    OBJ_COMMIT: b'commit',
+    OBJ_TREE: b'tree',
+    OBJ_BLOB: b'blob',
+    OBJ_TAG: b'tag',
+}
+TYPE_NUMBERS = {name: typ for typ, name in TYPE_NAMES.items()}
+
+
+def find_pack_names(text):
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
+    elif not isinstance(text, str):
+        return set()
+    pack_ptn = re.compile(r'pack-[\da-f]{40}')
+    return set(pack_ptn.findall(text))
+
+
+# https://github.com/git/git/blob/master/Documentation/technical/pack-format.txt
+def parse_pack_index(data):
+    assert data[:4] == b'\377tOc', 'not a v2 pack index'
+    version, = struct.unpack_from('!I', data, 4)
+    assert version == 2, 'Unsupported pack index version: %s' % version
+    return PackIndex(data)
+
+
+class PackIndex(object):
+    # looks names up in the sorted sha1 table of the index itself, a
+    # binary search within the fan-out bucket of the first byte, instead
+    # of a dict entry per object
+    def __init__(self, data):
+        self._data = data
+        # 256-entry fan-out table, the last entry is the object count
+        self._fanout = struct.unpack_from('!256I', data, 8)
+        self.count = self._fanout[-1]
+        self._sha1_base = 8 + 256 * 4
+        crc_base = self._sha1_base + self.count * 20
+        self._offset_base = crc_base + self.count * 4
+        self._large_base = self._offset_base + self.count * 4
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, raw):
+        return self.find(raw) is not None
+
+    def find(self, raw):
+        # position of raw in the sha1 table, or None
+        if len(raw) != RAW_LEN:
+            return None
+        lo = self._fanout[raw[0] - 1] if raw[0] else 0
+        hi = self._fanout[raw[0]]
+        data = self._data
+        base = self._sha1_base
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = base + mid * RAW_LEN
+            name = data[pos:pos + RAW_LEN]
+            if name < raw:
+                lo = mid + 1
+            elif name > raw:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def offset(self, raw):
+        n = self.find(raw)
+        if n is None:
+            return None
+        data = self._data
+        offset, = struct.unpack_from('!I', data, self._offset_base + n * 4)
+        if offset & 0x80000000:
+            # MSB set: index into the 8-byte large offset table
+            n = offset & 0x7FFFFFFF
+            offset, = struct.unpack_from('!Q', data, self._large_base + n * 8)
+        return offset
+
+
+def _tail(path, back, size=20):
+    # size bytes from back bytes before the end of path, or None
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-back, os.SEEK_END)
+            return f.read(size)
+    except OSError:
+        return None
+
+
+def check_pack_index(idxpath, packpath=None):
+    # a whole v2 index: signature, version, a size that fits its object
+    # count and its trailing sha1; with packpath, the pack it describes
+    with open(idxpath, 'rb') as f:
+        data = f.read()
+    sha1_base = 8 + 256 * 4
+    if len(data) < sha1_base + 40 or data[:8] != b'\377tOc\0\0\0\2':
+        return False
+    count, = struct.unpack_from('!I', data, sha1_base - 4)
+    # whatever follows the fixed tables is the 8-byte large offsets
+    large = len(data) - sha1_base - count * 28 - 40
+    if large < 0 or large % 8:
+        return False
+    if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+        return False
+    return packpath is None or _tail(packpath, 20) == data[-40:-20]
+
+
+def check_pack(packpath, idxpath=None):
+    # signature, version and the trailing sha1 over everything before it;
+    # with idxpath, the pack its index describes
+    sha1 = hashlib.sha1()
+    with open(packpath, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'PACK':
+            return False
+        if struct.unpack_from('!I', header, 4)[0] not in {2, 3}:
+            return False
+        sha1.update(header)
+        left = os.fstat(f.fileno()).st_size - len(header) - 20
+        if left < 0:
+            return False
+        while left > 0:
+            chunk = f.read(min(left, Config.CHUNK_SIZE))
+            if not chunk:
+                return False
+            sha1.update(chunk)
+            left -= len(chunk)
+        trailer = f.read(20)
+    if trailer != sha1.digest():
+        return False
+    return idxpath is None or _tail(idxpath, 40) == trailer
+
+
+def entry_header(typ, size):
+    # type and size varint in front of every pack entry
+    c = (typ << 4) | (size & 0x0F)
+    size >>= 4
+    out = bytearray()
+    while size:
+        out.append(c | 0x80)
+        c = size & 0x7F
+        size >>= 7
+    out.append(c)
+    return bytes(out)
+
+
+def build_pack_index(entries, pack_sha1):
+    # entries: [(raw sha1, crc32, offset)], a v2 index as parse_pack_index
+    # reads it
+    entries = sorted(entries)
+    fanout = [0] * 256
+    for raw, _, _ in entries:
+        fanout[raw[0]] += 1
+    total = 0
+    for i in range(256):
+        total += fanout[i]
+        fanout[i] = total
+    offsets = []
+    large = []
+    for _, _, offset in entries:
+        if offset < 0x80000000:
+            offsets.append(offset)
+        else:
+            offsets.append(0x80000000 | len(large))
+            large.append(offset)
+    data = b''.join([
+        b'\377tOc',
+        struct.pack('!I', 2),
+        struct.pack('!256I', *fanout),
+        b''.join(raw for raw, _, _ in entries),
+        struct.pack(f'!{len(entries)}I', *(crc for _, crc, _ in entries)),
+        struct.pack(f'!{len(offsets)}I', *offsets),
+        struct.pack(f'!{len(large)}Q', *large),
+        pack_sha1,
+    ])
+    return data + hashlib.sha1(data).digest()
+
+
+def write_pack(packdir, count, objects):
+    # objects: count (raw sha1, type, body) written undeltified in one
+    # sequential pass; returns (packpath, idxpath)
+    os.makedirs(packdir, exist_ok=True)
+    fd, partpath = tempfile.mkstemp(dir=packdir, prefix='.', suffix='.part')
+    try:
+        sha1 = hashlib.sha1()
+        entries = []
+        with os.fdopen(fd, 'wb') as f:
+            header = b'PACK' + struct.pack('!II', 2, count)
+            f.write(header)
+            sha1.update(header)
+            offset = len(header)
+            for raw, typ, body in objects:
+                data = entry_header(typ, len(body)) + zlib.compress(body)
+                f.write(data)
+                sha1.update(data)
+                entries.append((raw, zlib.crc32(data), offset))
+                offset += len(data)
+            assert len(entries) == count, 'pack object count mismatch'
+            f.write(sha1.digest())
+        name = 'pack-' + sha1.hexdigest()
+        packpath = os.path.join(packdir, name + '.pack')
+        idxpath = os.path.join(packdir, name + '.idx')
+        os.replace(partpath, packpath)
+        # git and open_packs only see a pack once its index is there
+        fd, partpath = tempfile.mkstemp(
+            dir=packdir, prefix='.', suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(build_pack_index(entries, sha1.digest()))
+        os.replace(partpath, idxpath)
+    finally:
+        if os.path.exists(partpath):
+            os.remove(partpath)
+    return packpath, idxpath
+
+
+def _delta_size(delta, pos):
+    size = shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        size |= (c & 0x7F) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, pos
+
+
+def apply_delta(base, delta):
+    src_size, pos = _delta_size(delta, 0)
+    assert src_size == len(base), 'delta base size mismatch'
+    dst_size, pos = _delta_size(delta, pos)
+
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # copy from base: 4 optional offset bytes, 3 optional size bytes
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (i * 8)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (i * 8)
+                    pos += 1
+            out += base[offset:offset + (size or 0x10000)]
+        elif op:
+            # insert the next `op` bytes of the delta
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise ValueError('invalid delta opcode')
+    assert len(out) == dst_size, 'delta result size mismatch'
+    return bytes(out)
+
+
+class LRUCache(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        cost = len(value[1])
+        if cost > self.capacity:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._data[key] = value
+            self.size += cost
+            while self.size > self.capacity:
+                _, old = self._data.popitem(last=False)
+                self.size -= len(old[1])
+
+
+class Pack(object):
+    def __init__(self, packpath, idxpath, store=None):
+        self.name = os.path.basename(packpath)
+        self.packpath = packpath
+        self.idxpath = idxpath
+        with open(idxpath, 'rb') as f:
+            self.index = parse_pack_index(f.read())
+        with open(packpath, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self._map[:4] == b'PACK', 'not a git pack file'
+        self.store = store
+
+    def __contains__(self, h):
+        # h: hex or raw sha1
+        return to_raw(h) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self._map.close()
+
+    def _inflate(self, pos, size):
+        d = zlib.decompressobj()
+        out = []
+        chunk = max(size, 4096)
+        while not d.eof and pos < len(self._map):
+            out.append(d.decompress(self._map[pos:pos + chunk]))
+            pos += chunk
+        return b''.join(out)
+
+    def _header(self, offset):
+        c = self._map[offset]
+        offset += 1
+        typ = (c >> 4) & 7
+        size = c & 0x0F
+        shift = 4
+        while c & 0x80:
+            c = self._map[offset]
+            offset += 1
+            size |= (c & 0x7F) << shift
+            shift += 7
+        return typ, size, offset
+
+    def _cache(self):
+        return self.store.cache if self.store else None
+
+    def read_at(self, offset):
+        cache = self._cache()
+        chain = []
+        while True:
+            key = (self.name, offset)
+            cached = cache.get(key) if cache else None
+            if cached is not None:
+                typ, body = cached
+                break
+            typ, size, pos = self._header(offset)
+            if typ == OBJ_OFS_DELTA:
+                c = self._map[pos]
+                pos += 1
+                base = c & 0x7F
+                while c & 0x80:
+                    c = self._map[pos]
+                    pos += 1
+                    base = ((base + 1) << 7) | (c & 0x7F)
+                chain.append((key, self._inflate(pos, size)))
+                offset -= base
+            elif typ == OBJ_REF_DELTA:
+                base = bytes(self._map[pos:pos + 20])
+                delta = self._inflate(pos + 20, size)
+                resolved = self.store.read(base) if self.store else None
+                if resolved is None and base in self.index:
+                    resolved = self.read_at(self.index.offset(base))
+                if resolved is None:
+                    raise KeyError('missing delta base: ' + to_hex(base))
+                chain.append((key, delta))
+                typ, body = resolved
+                break
+            else:
+                body = self._inflate(pos, size)
+                if cache:
+                    cache.put(key, (typ, body))
+                break
+        # apply deltas from the base towards the requested object
+        for key, delta in reversed(chain):
+            body = apply_delta(body, delta)
+            if cache:
+                cache.put(key, (typ, body))
+        return typ, body
+
+    def read(self, h):
+        offset = self.index.offset(to_raw(h))
+        if offset is None:
+            return None
+        return self.read_at(offset)
+
+
+class PackStore(object):
+    def __init__(self, cache_size=None):
+        self.packs = []
+        self.cache = LRUCache(cache_size or Config.PACK_CACHE)
+
+    def __contains__(self, h):
+        raw = to_raw(h)
+        return any(raw in p.index for p in self.packs)
+
+    def __len__(self):
+        return sum(len(p) for p in self.packs)
+
+    def add(self, packpath, idxpath):
+        pack = Pack(packpath, idxpath, self)
+        self.packs.append(pack)
+        return pack
+
+    def read(self, h):
+        raw = to_raw(h)
+        for p in self.packs:
+            if raw in p.index:
+                return p.read(raw)
+        return None
+
+    def read_raw(self, h):
+        # same layout as an inflated loose object: '<type> <size>\x00<body>'
+        obj = self.read(h)
+        if obj is None:
+            return None
+        typ, body = obj
+        return TYPE_NAMES[typ] + b' %d\x00' % len(body) + body
+
+    def close(self):
+        for p in self.packs:
+            p.close()
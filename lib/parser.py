@@ -1,8 +1,13 @@
 import binascii
 import collections
+import hashlib
 import mmap
 import re
 import struct
+import zlib
+
+from .config import Config
+from .sched import BLOB, COMMIT, TREE
 
 
 def find_sha1(text):
@@ -18,6 +23,14 @@ def find_sha1(text):
     return ret
 
 
+# sha1 is the raw 20-byte id
+TreeEntry = collections.namedtuple('TreeEntry', 'mode name sha1')
+
+GITLINK = '160000'
+# some old writers zero-padded the tree mode
+TREE_MODES = {'40000', '040000'}
+
+
 def parse_tree(tree):
     header, body = tree.split(b'\x00', 1)
 
@@ -25,13 +38,9 @@ def parse_tree(tree):
     #                    mode    name          sha1
     ptn = re.compile(br'(\d+) ([^\x00]*)\x00(.{20})', re.M | re.S)
 
-    for r in ptn.findall(body):
-        entry = collections.OrderedDict()
-        mode, name, sha1 = r
-        entry['mode'] = mode.decode('ascii')
-        entry['name'] = name.decode('utf-8', 'replace')
-        entry['sha1'] = binascii.hexlify(sha1).decode('ascii')
-        yield entry
+    for mode, name, sha1 in ptn.findall(body):
+        yield TreeEntry(
+            mode.decode('ascii'), name.decode('utf-8', 'replace'), sha1)
 
 
 def parse_commit(commit):
@@ -41,18 +50,40 @@ def parse_commit(commit):
 
     entry = collections.OrderedDict()
     entry['tree'] = None
-    entry['parent'] = None
+    entry['parent'] = []  # every parent, merges have several
     entry['author'] = None
     entry['committer'] = None
 
     info, message = body.split(b'\n\n', 1)
     for i in info.split(b'\n'):  # tree parent author committer
+        if i.startswith(b' '):
+            # continuation of a multi-line gpgsig or mergetag
+            continue
         key, value = i.split(b' ', 1)
-        entry[key.decode('ascii')] = value.strip().decode('utf-8', 'replace')
+        key = key.decode('ascii', 'replace')
+        value = value.strip().decode('utf-8', 'replace')
+        if key == 'parent':
+            entry['parent'].append(value)
+        else:
+            entry[key] = value
     entry['message'] = message.strip().decode('utf-8', 'replace')
     return entry
 
 
+def parse_tag(tag):
+    # sha1 of the tagged object
+    header, body = tag.split(b'\x00', 1)
+
+    assert header.startswith(b'tag '), 'not git tag data'
+
+    for i in body.split(b'\n'):
+        if i.startswith(b'object '):
+            return i[7:].strip().decode('ascii')
+        if not i:
+            break
+    return None
+
+
 def parse_blob(blob):
     header, body = blob.split(b'\x00', 1)
 
@@ -61,116 +92,373 @@ def parse_blob(blob):
     return collections.OrderedDict(data=body)
 
 
+def object_children(data):
+    # {raw sha1: fetch priority} of what a tree, commit or tag points to, no
+    # logging: also runs in workers
+    children = {}
+    if data.startswith(b'tree'):
+        for t in parse_tree(data):
+            # gitlinks are commits of another repository
+            if t.mode != GITLINK:
+                children[t.sha1] = TREE if t.mode in TREE_MODES else BLOB
+    elif data.startswith(b'commit'):
+        commit = parse_commit(data)
+        for p in commit['parent']:
+            children[binascii.unhexlify(p)] = COMMIT
+        if commit['tree']:
+            children[binascii.unhexlify(commit['tree'])] = TREE
+    elif data.startswith(b'tag'):
+        tagged = parse_tag(data)
+        if tagged:
+            # mostly a commit, a tree or blob is fetched early but once
+            children[binascii.unhexlify(tagged)] = COMMIT
+    return children
+
+
+def iter_inflate(f, chunk_size):
+    # peak memory stays around chunk_size whatever the object size
+    d = zlib.decompressobj()
+    while not d.eof:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            raise zlib.error('truncated zlib stream')
+        while chunk:
+            out = d.decompress(chunk, chunk_size)
+            if out:
+                yield out
+            chunk = d.unconsumed_tail
+
+
+def split_header(chunks):
+    # '<type> <size>\x00' from the first chunks, the rest is left in chunks
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if b'\x00' in head:
+            header, body = head.split(b'\x00', 1)
+            typ, size = header.split(b' ', 1)
+            return typ, int(size), body
+        assert len(head) < 64, 'not git object data'
+    raise ValueError('not git object data')
+
+
+# 62-byte fixed part of an index entry: ctime s/ns, mtime s/ns, dev, ino,
+# mode, uid, gid, size, sha1, flags; all big endian
+def loose_chunks(localpath):
+    with open(localpath, 'rb') as f:
+        yield from iter_inflate(f, Config.CHUNK_SIZE)
+
+
+OBJECT_TYPES = {b'blob', b'tree', b'commit', b'tag'}
+
+
+def verify_object(h, localpath, mode='full'):
+    # full: the inflated header and body hash to h; fast: a known type
+    # and an inflated body of the declared size, without hashing
+    if mode == 'off':
+        return True
+    chunks = loose_chunks(localpath)
+    try:
+        typ, size, first = split_header(chunks)
+        if typ not in OBJECT_TYPES or len(first) > size:
+            return False
+        sha1 = None
+        if mode != 'fast':
+            sha1 = hashlib.sha1(b'%s %d\x00' % (typ, size))
+            sha1.update(first)
+        length = len(first)
+        for chunk in chunks:
+            if sha1:
+                sha1.update(chunk)
+            length += len(chunk)
+        if length != size:
+            return False
+        return sha1 is None or sha1.hexdigest() == h
+    except (zlib.error, ValueError, AssertionError):
+        return False
+    finally:
+        chunks.close()
+
+
+INDEX_HEADER = struct.Struct('!4sII')
+INDEX_ENTRY = struct.Struct('!10I20sH')
+UINT16 = struct.Struct('!H')
+UINT32 = struct.Struct('!I')
+
+# (path, entry count or -1 when invalidated, subtree count, raw sha1 or None)
+CachedTree = collections.namedtuple('CachedTree', 'path entries subtrees sha1')
+# (path, stage 1-3 modes, stage 1-3 raw sha1s or None)
+ResolveUndo = collections.namedtuple('ResolveUndo', 'path modes sha1s')
+
+
+class IndexEntry(object):
+    # the unpacked fixed part is kept as is and decoded on access, most
+    # callers only look at sha1 and name
+    __slots__ = ('entry', 'fields', 'extra_flags', 'name', 'pretty')
+
+    def __init__(self, entry, fields, extra_flags, name, pretty=True):
+        self.entry = entry
+        self.fields = fields
+        self.extra_flags = extra_flags
+        self.name = name
+        self.pretty = pretty
+
+    def _time(self, i):
+        s, ns = self.fields[i], self.fields[i + 1]
+        return s + ns / 10e8 if self.pretty else (s, ns)
+
+    @property
+    def ctime(self):
+        return self._time(0)
+
+    @property
+    def mtime(self):
+        return self._time(2)
+
+    @property
+    def dev(self):
+        return self.fields[4]
+
+    @property
+    def ino(self):
+        return self.fields[5]
+
+    @property
+    def mode(self):
+        # 4-bit object type, 3-bit unused, 9-bit unix permission
+        mode = self.fields[6]
+        return '%06o' % mode if self.pretty else mode
+
+    @property
+    def uid(self):
+        return self.fields[7]
+
+    @property
+    def gid(self):
+        return self.fields[8]
+
+    @property
+    def size(self):
+        return self.fields[9]
+
+    @property
+    def sha1(self):
+        # raw 20-byte id
+        return self.fields[10]
+
+    @property
+    def flags(self):
+        return self.fields[11]
+
+    @property
+    def assume_valid(self):
+        return bool(self.flags & 0x8000)
+
+    @property
+    def extended(self):
+        # must be 0 in version 2
+        return bool(self.flags & 0x4000)
+
+    @property
+    def stage(self):
+        return bool(self.flags & 0x2000), bool(self.flags & 0x1000)
+
+    @property
+    def skip_worktree(self):
+        return bool(self.extra_flags & 0x4000)
+
+    @property
+    def intent_to_add(self):
+        return bool(self.extra_flags & 0x2000)
+
+
+def _varint(buf, pos):
+    # offset encoding of v4 path prefixes, see varint.c in git
+    c = buf[pos]
+    pos += 1
+    val = c & 0x7f
+    while c & 0x80:
+        c = buf[pos]
+        pos += 1
+        val = ((val + 1) << 7) | (c & 0x7f)
+    return val, pos
+
+
+def _cstring(buf, pos):
+    end = buf.find(b'\x00', pos)
+    if end < 0:
+        raise ValueError('unterminated string in index')
+    return buf[pos:end], end + 1
+
+
+def parse_cached_tree(data):
+    # TREE extension, subtrees follow their parent depth first
+    trees = []
+    pending = []  # (path prefix, subtrees left) of the open parents
+    pos = 0
+    while pos < len(data):
+        name, pos = _cstring(data, pos)
+        end = data.index(b'\n', pos)
+        entries, subtrees = data[pos:end].split(b' ')
+        entries, subtrees = int(entries), int(subtrees)
+        pos = end + 1
+        sha1 = None
+        if entries >= 0:
+            sha1 = bytes(data[pos:pos + 20])
+            pos += 20
+
+        while pending and pending[-1][1] == 0:
+            pending.pop()
+        prefix = ''
+        if pending:
+            prefix, left = pending[-1]
+            pending[-1] = prefix, left - 1
+        path = prefix + name.decode('utf-8', 'replace')
+        trees.append(CachedTree(path, entries, subtrees, sha1))
+        pending.append((path + '/' if path else '', subtrees))
+    return trees
+
+
+def parse_resolve_undo(data):
+    entries = []
+    pos = 0
+    while pos < len(data):
+        name, pos = _cstring(data, pos)
+        modes = []
+        for _ in range(3):
+            mode, pos = _cstring(data, pos)
+            modes.append(int(mode, 8))
+        sha1s = []
+        for mode in modes:
+            sha1s.append(bytes(data[pos:pos + 20]) if mode else None)
+            pos += 20 if mode else 0
+        entries.append(
+            ResolveUndo(name.decode('utf-8', 'replace'), modes, sha1s))
+    return entries
+
+
+def parse_index_offsets(data):
+    # IEOT extension: [(offset, entry count)] of independent entry blocks
+    version, = UINT32.unpack_from(data, 0)
+    assert version == 1, 'Unsupported IEOT version: %s' % version
+    return [
+        struct.unpack_from('!II', data, pos)
+        for pos in range(4, len(data) - 7, 8)
+    ]
+
+
+INDEX_EXTENSIONS = {
+    b'TREE': parse_cached_tree,
+    b'REUC': parse_resolve_undo,
+    b'IEOT': parse_index_offsets,
+    b'EOIE': lambda data: UINT32.unpack_from(data, 0)[0],
+}
+
+
+def parse_index_extensions(buf, pos):
+    # everything between the last entry and the trailing checksum;
+    # unknown extensions (UNTR, FSMN, link, ...) are skipped
+    extensions = collections.OrderedDict()
+    end = len(buf) - 20
+    while pos + 8 <= end:
+        sig = bytes(buf[pos:pos + 4])
+        size, = UINT32.unpack_from(buf, pos + 4)
+        pos += 8
+        parser = INDEX_EXTENSIONS.get(sig)
+        if parser is not None:
+            extensions[sig.decode('ascii')] = parser(buf[pos:pos + size])
+        pos += size
+    return extensions
+
+
 # https://github.com/git/git/blob/master/Documentation/technical/index-format.txt
 def parse_index(filename, pretty=True):
+    # yields the header, then the entries; header['extensions'] is filled
+    # in once the last entry has been consumed
     with open(filename, 'rb') as o:
         f = mmap.mmap(o.fileno(), 0, access=mmap.ACCESS_READ)
-
-        def read(format):
-            # 'All binary numbers are in network byte order.'
-            # Hence '!' = network order, big endian
-            format = '! ' + format
-            bytes = f.read(struct.calcsize(format))
-            return struct.unpack(format, bytes)[0]
-
-        index = collections.OrderedDict()
-
-        # 4-byte signature, b'DIRC'
-        index['signature'] = f.read(4).decode('ascii')
-        assert index['signature'] == 'DIRC', 'not a git index file'
-
-        # 4-byte version number
-        index['version'] = read('I')
-        assert index['version'] in {
-            2, 3
-        }, 'Unsupported version: %s' % index['version']
-
-        # 32-bit number of index entries, i.e. 4-byte
-        index['entries'] = read('I')
-
-        yield index
-
-        for n in range(index['entries']):
-            entry = collections.OrderedDict()
-
-            entry['entry'] = n + 1
-
-            entry['ctime_seconds'] = read('I')
-            entry['ctime_nanoseconds'] = read('I')
-            if pretty:
-                entry['ctime'] = entry['ctime_seconds']
-                entry['ctime'] += entry['ctime_nanoseconds'] / 10e8
-                del entry['ctime_seconds']
-                del entry['ctime_nanoseconds']
-
-            entry['mtime_seconds'] = read('I')
-            entry['mtime_nanoseconds'] = read('I')
-            if pretty:
-                entry['mtime'] = entry['mtime_seconds']
-                entry['mtime'] += entry['mtime_nanoseconds'] / 10e8
-                del entry['mtime_seconds']
-                del entry['mtime_nanoseconds']
-
-            entry['dev'] = read('I')
-            entry['ino'] = read('I')
-
-            # 4-bit object type, 3-bit unused, 9-bit unix permission
-            entry['mode'] = read('I')
-            if pretty:
-                entry['mode'] = '%06o' % entry['mode']
-
-            entry['uid'] = read('I')
-            entry['gid'] = read('I')
-            entry['size'] = read('I')
-
-            entry['sha1'] = binascii.hexlify(f.read(20)).decode('ascii')
-            entry['flags'] = read('H')
-
-            # 1-bit assume-valid
-            entry['assume-valid'] = bool(entry['flags'] & (0b10000000 << 8))
-            # 1-bit extended, must be 0 in version 2
-            entry['extended'] = bool(entry['flags'] & (0b01000000 << 8))
-            # 2-bit stage (?)
-            stage_one = bool(entry['flags'] & (0b00100000 << 8))
-            stage_two = bool(entry['flags'] & (0b00010000 << 8))
-            entry['stage'] = stage_one, stage_two
-            # 12-bit name length, if the length is less than 0xFFF (else, 0xFFF)
-            namelen = entry['flags'] & 0xFFF
-
-            # 62 bytes so far
-            entrylen = 62
-
-            if entry['extended'] and (index['version'] == 3):
-                entry['extra-flags'] = read('H')
-                # 1-bit reserved
-                entry['reserved'] = bool(entry['extra-flags'] & (0b10000000 << 8))
-                # 1-bit skip-worktree
-                entry['skip-worktree'] = bool(entry['extra-flags'] & (0b01000000 << 8))
-                # 1-bit intent-to-add
-                entry['intent-to-add'] = bool(entry['extra-flags'] & (0b00100000 << 8))
-                # 13-bits unused
-                # used = entry['extra-flags'] & (0b11100000 << 8)
-                # check(not used, 'Expected unused bits in extra-flags')
-                entrylen += 2
-
-            if namelen < 0xFFF:
-                entry['name'] = f.read(namelen).decode('utf-8', 'replace')
-                entrylen += namelen
-            else:
-                # Do it the hard way
-                name = []
-                while True:
-                    byte = f.read(1)
-                    if byte == '\x00':
-                        break
-                    name.append(byte)
-                entry['name'] = b''.join(name).decode('utf-8', 'replace')
-                entrylen += 1
-
-            padlen = (8 - (entrylen % 8)) or 8
-            nuls = f.read(padlen)
-            assert set(nuls) == {0}, 'padding contained non-NUL'
-
-            yield entry
-
-        f.close()
+        try:
+            index = collections.OrderedDict()
+
+            signature, version, count = INDEX_HEADER.unpack_from(f, 0)
+            index['signature'] = signature.decode('ascii', 'replace')
+            assert index['signature'] == 'DIRC', 'not a git index file'
+            index['version'] = version
+            assert version in {2, 3, 4}, 'Unsupported version: %s' % version
+            index['entries'] = count
+            index['extensions'] = collections.OrderedDict()
+
+            yield index
+
+            # one struct call per entry straight from the mmap, this loop
+            # is the hot path for large indexes
+            unpack_entry = INDEX_ENTRY.unpack_from
+            entry_size = INDEX_ENTRY.size
+            find = f.find
+            prev = b''
+            pos = INDEX_HEADER.size
+            for n in range(count):
+                fields = unpack_entry(f, pos)
+                flags = fields[11]
+                start = pos
+                pos += entry_size
+
+                extra_flags = 0
+                if flags & 0x4000 and version >= 3:
+                    extra_flags, = UINT16.unpack_from(f, pos)
+                    pos += 2
+
+                if version == 4:
+                    # the previous name minus some trailing bytes, plus a
+                    # NUL-terminated suffix; no padding
+                    strip = f[pos]
+                    if strip < 0x80:
+                        pos += 1
+                    else:
+                        strip, pos = _varint(f, pos)
+                    end = find(b'\x00', pos)
+                    name = prev[:len(prev) - strip] + f[pos:end]
+                    prev = name
+                    pos = end + 1
+                else:
+                    namelen = flags & 0xFFF
+                    if namelen < 0xFFF:
+                        end = pos + namelen
+                    else:
+                        end = find(b'\x00', pos)
+                    name = f[pos:end]
+                    # 1-8 NULs pad the entry to a multiple of 8 bytes
+                    pos = start + ((end - start + 8) & ~7)
+
+                yield IndexEntry(n + 1, fields, extra_flags,
+                                 name.decode('utf-8', 'replace'), pretty)
+
+            index['extensions'].update(parse_index_extensions(f, pos))
+        finally:
+            f.close()
+
+
+def index_extensions(filename):
+    # extensions only, entries are skipped when the index has an EOIE
+    with open(filename, 'rb') as o:
+        f = mmap.mmap(o.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # EOIE is always last: sig, size 24, offset, hash, checksum
+            eoie = len(f) - 20 - 32
+            if eoie > INDEX_HEADER.size and f[eoie:eoie + 8] == \
+                    b'EOIE' + UINT32.pack(24):
+                offset, = UINT32.unpack_from(f, eoie + 8)
+                return parse_index_extensions(f, offset)
+        finally:
+            f.close()
+    entries = parse_index(filename, pretty=False)
+    index = next(entries)
+    for _ in entries:
+        pass
+    return index['extensions']
+
+
+def index_trees(filename):
+    # raw sha1s of the valid cached trees, extra seeds for the walk
+    trees = index_extensions(filename).get('TREE', ())
+    return [t.sha1 for t in trees if t.sha1 is not None]
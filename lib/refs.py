@@ -0,0 +1,137 @@
+import os
+import re
+
+from . import log
+from .pack import find_pack_names
+from .parser import find_sha1
+
+# path, cover, hash_cap; covered files are fetched again on a re-scan, a
+# conditional request when the copy on disk is unchanged
+PROBES = [
+    ('HEAD', True, True),
+    ('config', True, False),
+    ('description', True, False),
+    ('info/exclude', True, False),
+    ('info/refs', True, True),
+    ('refs/remotes/origin/HEAD', True, True),
+    ('refs/stash', True, True),
+    ('packed-refs', True, True),
+    ('logs/HEAD', True, True),
+    ('logs/refs/remotes/origin/HEAD', True, True),
+    ('logs/refs/stash', True, True),
+    ('FETCH_HEAD', True, True),
+    ('ORIG_HEAD', True, True),
+    ('COMMIT_EDITMSG', True, False),
+    ('index', True, False),
+    ('objects/info/packs', True, False),
+]
+
+BRANCH_PREFIXES = ['refs/heads/', 'refs/remotes/origin/']
+
+# where git files mention refs or branch names
+REF_PTNS = [
+    # HEAD, packed-refs, info/refs, config merge = ...
+    re.compile(r'(refs/(?:heads|tags|remotes)/[^\s^~:]+)'),
+    # FETCH_HEAD: <sha1>\t\tbranch 'x' of <url>
+    re.compile(r"\t(branch|tag) '([^']+)' of "),
+    # config: [branch "x"]
+    re.compile(r'\[(branch) "([^"]+)"\]'),
+    # reflogs: checkout: moving from x to y
+    re.compile(r'checkout: moving from (\S+) to (\S+)'),
+]
+
+REF_NAME = re.compile(r'^[\w.+@/-]+$')
+SHA1 = re.compile(r'^[\da-f]{40}$')
+
+
+def load_wordlist(path):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [
+            line.strip() for line in f
+            if line.strip() and not line.startswith('#')
+        ]
+
+
+def ref_paths(name):
+    # refs a wordlist entry or a bare branch name may live at; a detached
+    # checkout logs a sha1 where the branch name would be
+    if SHA1.match(name):
+        return []
+    if name.startswith('refs/'):
+        return [name]
+    if name.startswith('tags/'):
+        return ['refs/' + name]
+    return [prefix + name for prefix in BRANCH_PREFIXES]
+
+
+def valid_ref(ref):
+    # names come from the server, keep them inside .git
+    return (REF_NAME.match(ref) and '..' not in ref and
+            not ref.endswith(('/', '.lock')))
+
+
+def find_refs(data):
+    # full ref paths mentioned in a file
+    if not data:
+        return set()
+    text = data.decode('utf-8', 'replace')
+    refs = set(REF_PTNS[0].findall(text))
+    for kind, name in REF_PTNS[1].findall(text):
+        if kind == 'tag':
+            refs.add('refs/tags/' + name)
+        else:
+            refs.add('refs/remotes/origin/' + name)
+    for _, name in REF_PTNS[2].findall(text):
+        refs.add('refs/heads/' + name)
+    for names in REF_PTNS[3].findall(text):
+        for name in names:
+            refs.update(ref_paths(name))
+    return {ref for ref in refs if valid_ref(ref)}
+
+
+class RefDiscovery(object):
+    # turns fetched files into more paths to probe until nothing new
+    # shows up; sha1s are only handed to the walk once it is all done
+    def __init__(self, wordlist=()):
+        self.sha1 = set()
+        self.packnames = set()
+        self.refs = set()
+        self._seen = set()
+        self._wordlist = wordlist
+
+    def _probe(self, path, cover=True, hash_cap=True):
+        if path in self._seen:
+            return []
+        self._seen.add(path)
+        return [(path, cover, hash_cap)]
+
+    def probes(self):
+        probes = []
+        for path, cover, hash_cap in PROBES:
+            probes += self._probe(path, cover, hash_cap)
+        for name in self._wordlist:
+            for ref in ref_paths(name):
+                if valid_ref(ref):
+                    probes += self._probe(ref)
+        return probes
+
+    def feed(self, path, data, hash_cap=False):
+        probes = []
+        if not data:
+            return probes
+        self.packnames.update(find_pack_names(data))
+        if hash_cap:
+            h = find_sha1(data)
+            log.debug(f'{path}: {h}')
+            self.sha1.update(h)
+        if path.startswith('refs/'):
+            # a ref that exists may have a reflog
+            self.refs.add(path)
+            probes += self._probe('logs/' + path)
+        for ref in find_refs(data) - self.refs:
+            self.refs.add(ref)
+            probes += self._probe(ref)
+            probes += self._probe('logs/' + ref)
+        return probes
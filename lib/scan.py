@@ -1,39 +1,164 @@
+import concurrent.futures
 import os
+import shutil
+import threading
+import time
 import urllib.parse
 
-from . import log
+from . import aio, log
+from .cache import negative, validators
 from .config import Config
-from .git import clone, fake_clone, init, validate_repo
-from .net import dirlist_spider, isdirlist, load_or_get
+from .git import (clone, fake_clone, head_ref, init, recovered_any,
+                  start_clone, validate_repo)
+from .history import restore_history
+from .metrics import metrics
+from .net import dirlist_spider, download, isdirlist, load_or_get
+from .parser import find_sha1
+from .state import meta_path, walk_interrupted
 
 
 class GitScanner(object):
     def __init__(self, url):
         self.endpoint = url.rstrip('/')
-        distname = urllib.parse.urlparse(url).netloc.replace(':', '_')
+        parts = urllib.parse.urlparse(self.endpoint)
+        # one host may expose several repositories under different paths
+        distname = (parts.netloc + parts.path).replace(':', '_').replace(
+            '/', '_')
         self.cwd = os.path.join(Config.DIST, distname)
         os.makedirs(self.cwd, exist_ok=True)
         localgit = os.path.join(self.cwd, '.git')
         netgit = self.endpoint + '/.git'
         self.gitpair = (localgit, netgit)
+        # set when the race is decided, see probe_plans
+        self._race_over = threading.Event()
 
     def scan(self):
+        localgit, netgit = self.gitpair
+        # not meta_path: plan A needs an empty directory to clone into
+        negative.load(os.path.join(localgit, 'githack', 'negative.json'))
+        validators.load(os.path.join(localgit, 'githack', 'validators.json'))
+
+        if walk_interrupted(self.gitpair):
+            # the repository may look valid already, commits and trees are
+            # fetched first; only plan C can finish what it started
+            log.info('plan C: resume the interrupted fake clone')
+            with log.RunningBar('plan C'), metrics.time('plan.C'):
+                result = self.plan_c()
+        elif Config.RACE:
+            result = self.race()
+        else:
+            result = self.sequential()
+
+        if os.path.isdir(localgit):
+            negative.save(meta_path(self.gitpair, 'negative.json'), netgit)
+            validators.save(meta_path(self.gitpair, 'validators.json'), netgit)
+
+        if result:
+            log.success('clone success => ' + self.cwd)
+        else:
+            log.failure('clone fail')
+
+        if result and Config.HISTORY:
+            log.info('history: restore every reachable commit')
+            with log.RunningBar('history'):
+                restore_history(self.gitpair)
+        return result
+
+    def sequential(self):
         log.info('plan A: try direct clone')
-        with log.RunningBar('plan A'):
+        with log.RunningBar('plan A'), metrics.time('plan.A'):
             result = self.plan_a()
         if not result:
             log.info('plan B: try directory listing')
-            with log.RunningBar('plan B'):
+            with log.RunningBar('plan B'), metrics.time('plan.B'):
                 result = self.plan_b()
         if not result:
             log.info('plan C: try fake clone')
-            with log.RunningBar('plan C'):
+            with log.RunningBar('plan C'), metrics.time('plan.C'):
                 result = self.plan_c()
+        return result
 
-        if result:
-            log.success('clone success => ' + self.cwd)
+    def race(self):
+        localgit, netgit = self.gitpair
+        if os.path.exists(localgit) and validate_repo(self.cwd):
+            log.success('local git valid')
+            return True
+
+        log.info('race: probe plan A, B and C at once')
+        with log.RunningBar('race') as bar:
+            plan = self.probe_plans()
+            bar.msg = f'race (plan {plan or "none"})'
+        if plan == 'A':
+            return True
+        if plan == 'B':
+            log.info('plan B: try directory listing')
+            with log.RunningBar('plan B'):
+                if self.plan_b():
+                    return True
+        if plan in {'B', 'C'}:
+            log.info('plan C: try fake clone')
+            with log.RunningBar('plan C'):
+                return self.plan_c()
+        return False
+
+    def probe_c(self):
+        localgit, netgit = self.gitpair
+        if not os.path.exists(localgit):
+            init(self.cwd)
+        # not load_or_get: the HEAD written by init proves nothing
+        head = download(os.path.join(localgit, 'HEAD'), netgit + '/HEAD')
+        if not self._race_over.is_set():
+            # fetched now, reused by plan C
+            load_or_get(self.gitpair, 'index')
+        return bool(head_ref(head) or find_sha1(head))
+
+    def probe_plans(self):
+        # the first viable plan wins, the others are cancelled; files the
+        # probes fetched stay in dist/ for the winner
+        clonedir = self.cwd + '.clone'
+        shutil.rmtree(clonedir, ignore_errors=True)
+        proc = start_clone(clonedir, self.endpoint)
+        self._race_over.clear()
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        probe_b = executor.submit(isdirlist, self.gitpair[1])
+        probe_c = executor.submit(self.probe_c)
+        plan = None
+
+        def _viable(future):
+            return not future.exception() and future.result()
+
+        try:
+            while plan is None:
+                code = proc.poll()
+                if code == 0:
+                    plan = 'A'
+                elif probe_b.done() and _viable(probe_b):
+                    plan = 'B'
+                elif probe_b.done() and probe_c.done():
+                    if _viable(probe_c):
+                        plan = 'C'
+                    elif code is not None:
+                        break
+                time.sleep(0.05)
+        finally:
+            if plan != 'A' and proc.poll() is None:
+                proc.kill()
+            _, stderr = proc.communicate()
+            executor.shutdown(wait=False)
+            # probe_c writes into self.cwd, which plan A replaces and plan B
+            # and C go on with; isdirlist only reads
+            self._race_over.set()
+            concurrent.futures.wait([probe_c])
+
+        if plan == 'A':
+            log.info('clone success')
+            shutil.rmtree(self.cwd, ignore_errors=True)
+            os.replace(clonedir, self.cwd)
         else:
-            log.failure('clone fail')
+            log.debug(f'git:{proc.returncode},stderr={stderr}')
+            shutil.rmtree(clonedir, ignore_errors=True)
+        log.info(f'race won by plan {plan}' if plan else 'race: no plan viable')
+        return plan
 
     def plan_a(self):
         localgit, _ = self.gitpair
@@ -54,7 +179,10 @@ class GitScanner(object):
             if not os.path.exists(localgit):
                 init(self.cwd)
 
-            dirlist_spider(self.gitpair)
+            if Config.ENGINE == 'async':
+                aio.dirlist_spider(self.gitpair)
+            else:
+                dirlist_spider(self.gitpair)
             load_or_get(self.gitpair, 'packed-refs', True)
             load_or_get(self.gitpair, 'config', True)
             load_or_get(self.gitpair, 'HEAD', True)
@@ -71,8 +199,15 @@ class GitScanner(object):
         if not os.path.exists(localgit):
             init(self.cwd)
 
-        fake_clone(self.gitpair)
+        if Config.ENGINE == 'async':
+            aio.fake_clone(self.gitpair)
+        else:
+            fake_clone(self.gitpair)
 
-        if not validate_repo(self.cwd):
-            log.warning('plan C done, but some files are missing')
+        if validate_repo(self.cwd):
+            return True
+        if not recovered_any(localgit):
+            log.failure('plan C recovered nothing')
+            return False
+        log.warning('plan C done, but some files are missing')
         return True
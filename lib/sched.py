@@ -0,0 +1,45 @@
+import heapq
+import itertools
+
+from .oid import ShaStack
+
+# fetch priority classes, lowest first: what reveals more work goes before
+# what only fills the disk, and the checked-out snapshot before history
+REF = 0
+COMMIT = 1
+TREE = 2
+INDEX_BLOB = 3
+BLOB = 4
+
+
+class Scheduler(object):
+    # raw sha1s wait in one ShaStack per class, depth first inside a class;
+    # index entries wait in a heap, in index order or smallest file first
+    def __init__(self, by_size=False):
+        self.by_size = by_size
+        self._stacks = [ShaStack() for _ in range(BLOB + 1)]
+        self._entries = []
+        self._seq = itertools.count()
+
+    def push(self, raw, priority):
+        self._stacks[priority].push(raw)
+
+    def push_entry(self, entry):
+        seq = next(self._seq)
+        key = entry.size if self.by_size else seq
+        heapq.heappush(self._entries, (key, seq, entry))
+
+    def pop(self):
+        # (priority, raw sha1 or index entry)
+        for priority, stack in enumerate(self._stacks):
+            if priority == INDEX_BLOB and self._entries:
+                return INDEX_BLOB, heapq.heappop(self._entries)[2]
+            if stack:
+                return priority, stack.pop()
+        raise IndexError('pop from an empty scheduler')
+
+    def __len__(self):
+        return sum(map(len, self._stacks)) + len(self._entries)
+
+    def __bool__(self):
+        return bool(self._entries) or any(self._stacks)
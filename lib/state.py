@@ -0,0 +1,116 @@
+import os
+import sqlite3
+import threading
+import time
+
+from .oid import ShaSet, ShaStack, to_hex, to_raw
+
+FETCHED = 'fetched'
+MISSING = 'missing'
+PARSED = 'parsed'
+
+
+def meta_path(gitpair, name):
+    # scan state lives next to the recovered repository, git ignores it
+    localgit, _ = gitpair
+    metadir = os.path.join(localgit, 'githack')
+    os.makedirs(metadir, exist_ok=True)
+    return os.path.join(metadir, name)
+
+
+def walk_interrupted(gitpair):
+    # a walk that started and never finished: its state.db has no walked
+    # marker, see fake_clone
+    localgit, _ = gitpair
+    path = os.path.join(localgit, 'githack', 'state.db')
+    if not os.path.exists(path):
+        return False
+    state = WalkState(path)
+    try:
+        return state.get('walked') is None
+    finally:
+        state.close()
+
+
+class WalkState(object):
+    FLUSH_ROWS = 1000
+    FLUSH_SECONDS = 2
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS objects ('
+                         'sha1 TEXT PRIMARY KEY, '
+                         'state TEXT NOT NULL, '
+                         'type TEXT, '
+                         'children TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                         'key TEXT PRIMARY KEY, '
+                         'value TEXT)')
+        self._db.commit()
+        self._lock = threading.Lock()
+        self._rows = []
+        self._flushed = time.monotonic()
+
+    def record(self, h, typ, children=()):
+        if typ is None:
+            state = MISSING
+        elif typ in {'tree', 'commit', 'tag'}:
+            state = PARSED
+        else:
+            state = FETCHED
+        with self._lock:
+            self._rows.append(
+                (h, state, typ, ' '.join(to_hex(c) for c in children)))
+            if (len(self._rows) >= self.FLUSH_ROWS or
+                    time.monotonic() - self._flushed > self.FLUSH_SECONDS):
+                self._flush()
+
+    def _flush(self):
+        self._db.executemany(
+            'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)', self._rows)
+        self._db.commit()
+        self._rows = []
+        self._flushed = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def frontier(self, seeds):
+        # (every raw sha1 known so far, raw sha1s still to visit)
+        self.flush()
+        done = ShaSet()
+        known = ShaSet(to_raw(h) for h in seeds)
+        cur = self._db.execute(
+            'SELECT sha1, children FROM objects WHERE state != ?', (MISSING, ))
+        for h, children in cur:
+            done.add(to_raw(h))
+            if children:
+                known.update(to_raw(c) for c in children.split(' '))
+        known.update(done)
+        # missing objects are tried again, they may have been transient
+        return known, ShaStack(h for h in known if h not in done)
+
+    def missing(self):
+        self.flush()
+        cur = self._db.execute('SELECT sha1 FROM objects WHERE state = ?',
+                               (MISSING, ))
+        return [h for h, in cur]
+
+    def get(self, key):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?',
+                               (key, )).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                             (key, value))
+            self._db.commit()
+
+    def close(self):
+        self.flush()
+        self._db.close()
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from . import log
+from .config import Config
+from .metrics import metrics
+from .pack import check_pack, check_pack_index
+from .parser import verify_object
+
+
+def _link(src, dst):
+    # dst appears whole or not at all, other threads may be reading it
+    dirname = os.path.dirname(dst)
+    os.makedirs(dirname, exist_ok=True)
+    try:
+        os.link(src, dst)
+        return
+    except FileExistsError:
+        return
+    except OSError:
+        # no hardlinks across devices or on some filesystems
+        pass
+    fd, partpath = tempfile.mkstemp(dir=dirname, prefix='.', suffix='.part')
+    os.close(fd)
+    try:
+        shutil.copyfile(src, partpath)
+        os.replace(partpath, dst)
+    finally:
+        if os.path.exists(partpath):
+            os.remove(partpath)
+
+
+def content_ok(path, filepath):
+    # path is named after its content, filepath must hold just that: a waf
+    # page one target serves would otherwise reach every later target
+    name = path.lstrip('/')[len('objects/'):]
+    base, ext = os.path.splitext(filepath)
+    if name.startswith('pack/') and ext == '.idx':
+        packpath = base + '.pack'
+        return check_pack_index(
+            filepath, packpath if os.path.exists(packpath) else None)
+    if name.startswith('pack/') and ext == '.pack':
+        idxpath = base + '.idx'
+        return check_pack(filepath,
+                          idxpath if os.path.exists(idxpath) else None)
+    h = name.replace('/', '')
+    if len(h) == 40 and name[2:3] == '/':
+        return verify_object(h, filepath)
+    return False
+
+
+class ObjectStore(object):
+    # loose objects and packs shared by every target of a run and by later
+    # runs, under their path in objects/ (named after their content); hits
+    # are hardlinked into the target repository, the least recently used
+    # files go first once Config.STORE_SIZE is reached
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _path(self, path):
+        path = path.lstrip('/')
+        if not path.startswith('objects/') or '..' in path.split('/'):
+            return None
+        return os.path.join(Config.STORE, path[len('objects/'):])
+
+    def get(self, path, localpath):
+        if not Config.STORE:
+            return False
+        storepath = self._path(path)
+        if storepath is None:
+            return False
+        try:
+            # checked again on the way out, what older runs put is trusted
+            # no more than what a target serves
+            if not content_ok(path, storepath):
+                log.warning(f'store: bad copy of {path}, discarded')
+                metrics.counter('store.rejected').inc()
+                self.discard(path)
+                return False
+            # the mtime is the lru clock
+            os.utime(storepath)
+            _link(storepath, localpath)
+        except FileNotFoundError:
+            metrics.counter('store.misses').inc()
+            return False
+        log.debug('store hit: ' + path)
+        metrics.counter('store.hits').inc()
+        metrics.counter('store.bytes').inc(os.path.getsize(localpath))
+        return True
+
+    def put(self, path, localpath):
+        if not Config.STORE:
+            return
+        storepath = self._path(path)
+        if storepath is None or os.path.exists(storepath):
+            return
+        if not content_ok(path, localpath):
+            log.debug(f'store {path} rejected: content does not match')
+            metrics.counter('store.rejected').inc()
+            return
+        try:
+            _link(localpath, storepath)
+            size = os.path.getsize(storepath)
+        except OSError as err:
+            log.debug(f'store {path} failed: {err}')
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._files())
+            else:
+                self._size += size
+            if self._size > Config.STORE_SIZE:
+                self._evict()
+
+    def discard(self, path):
+        # a bad copy must not be handed out again
+        storepath = self._path(path) if Config.STORE else None
+        if storepath and os.path.exists(storepath):
+            os.remove(storepath)
+            with self._lock:
+                self._size = None
+
+    def _files(self):
+        for dirpath, _, filenames in os.walk(Config.STORE):
+            for name in filenames:
+                if name.endswith('.part'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def _evict(self):
+        # down to 90% of the cap, so that a full store isn't walked on
+        # every put
+        goal = Config.STORE_SIZE * 0.9
+        files = sorted(self._files())
+        self._size = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if self._size <= goal:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            metrics.counter('store.evicted').inc()
+
+
+store = ObjectStore()